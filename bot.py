@@ -1,30 +1,38 @@
 import os
 import json
+import time
+import random
 import logging
 import datetime
-from typing import Dict, List, Optional, Union, Any
+import functools
+import collections
+from typing import Dict, List, Optional, Tuple, Union, Any
 import asyncio
 
 from dotenv import load_dotenv
-from aiogram import Bot, Dispatcher, types
-try:
-    # Aiogram 3.x
-    from aiogram.fsm.storage.memory import MemoryStorage
-    from aiogram.fsm.context import FSMContext
-    from aiogram.fsm.state import State, StatesGroup
-except ImportError:
-    # Aiogram 2.x fallback
-    from aiogram.contrib.fsm_storage.memory import MemoryStorage
-    from aiogram.dispatcher import FSMContext
-    from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram import Bot, Dispatcher, F, Router, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import Command, CommandObject, StateFilter
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message, CallbackQuery
+import aiohttp
 from aiohttp import web
 from pathlib import Path
 
+try:
+    # Optional: much faster JSON encode/decode for hot paths
+    import orjson
+except ImportError:
+    orjson = None
+
 # Import database functions
 import db
 # Import payment provider
 from config import get_payment_provider
+from payment_providers import PaymentProvider
 
 # Load environment variables
 dotenv_path = Path('.') / '.env'
@@ -37,15 +45,42 @@ logging.basicConfig(level=logging.INFO)
 API_TOKEN = os.getenv('TELEGRAM_API_TOKEN')
 GROUP_ID = os.getenv('TELEGRAM_GROUP_ID')
 
-bot = Bot(token=API_TOKEN)
-
-# Initialize Dispatcher based on aiogram version
-try:
-    # Try aiogram 2.x initialization (requires bot)
-    dp = Dispatcher(bot, storage=MemoryStorage())
-except TypeError:
-    # Fallback to aiogram 3.x initialization (no bot in init)
-    dp = Dispatcher(storage=MemoryStorage())
+# Configuration known at startup - bind once instead of calling os.getenv
+# inside every handler
+CURRENCY = os.getenv('CURRENCY', 'USD')
+DEFAULT_PRICE = float(os.getenv('DEFAULT_SUBSCRIPTION_PRICE', '9.99'))
+DEMO_MODE = os.getenv('PAYMENT_PROVIDER', 'demo').lower() == 'demo'
+
+# Webhook configuration (polling is used unless USE_WEBHOOK is set)
+USE_WEBHOOK = os.getenv('USE_WEBHOOK', 'false').lower() in ('1', 'true', 'yes')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', 'localhost')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+
+# One shared HTTP session with a keepalive connection pool, so bursts of
+# sendMessage calls reuse connections instead of paying a TLS handshake each.
+# With orjson installed, update parsing and outgoing call serialization go
+# through its C encoder instead of the stdlib - this is per send_message /
+# send_invoice and per incoming update, so it adds up under webhook load.
+if orjson is not None:
+    _session = AiohttpSession(json_loads=orjson.loads,
+                              json_dumps=lambda o: orjson.dumps(o).decode())
+else:
+    _session = AiohttpSession()
+# keepalive_timeout above Telegram's idle window keeps connections warm
+# between periodic sweeps instead of re-handshaking for each batch
+_session._connector_init.update(limit=100, limit_per_host=30, ttl_dns_cache=300,
+                                keepalive_timeout=75)
+bot = Bot(token=API_TOKEN, session=_session)
+
+dp = Dispatcher(storage=MemoryStorage())
+
+# Handlers register on the router at import via decorators - the idiomatic
+# aiogram 3 pattern, which also lets filters compile once up front
+router = Router(name="main")
+dp.include_router(router)
 
 payment_provider = get_payment_provider()
 
@@ -54,134 +89,314 @@ class UserStates(StatesGroup):
     main_menu = State()
     payment_process = State()
 
-async def _set_state_safe(state: Optional[FSMContext], target_state: Any):
+async def _set_state_safe(state: Optional[FSMContext], target_state: State):
+    """Set the FSM state when a context is available (cmd_start may run without one)."""
     if state is not None:
-        for candidate in (target_state, getattr(target_state, "state", None)):
-            if candidate is None:
-                continue
-            try:
-                await state.set_state(candidate)
-                return
-            except Exception:
-                pass
-    try:
-        await target_state.set()
-    except Exception:
-        pass
+        await state.set_state(target_state)
+
 
+async def _edit_or_send(callback_query: CallbackQuery, text: str, reply_markup: InlineKeyboardMarkup, parse_mode: Optional[str] = None):
+    """Edit the callback message in place, falling back to a fresh message.
+
+    When the user taps the same button twice Telegram rejects the edit with
+    'message is not modified' - in that case just ack the callback instead
+    of sending a duplicate message.
+    """
+    try:
+        await callback_query.message.edit_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except TelegramBadRequest as e:
+        if 'not modified' in str(e):
+            await callback_query.answer()
+            return
+        await bot.send_message(callback_query.from_user.id, text, reply_markup=reply_markup, parse_mode=parse_mode)
+
+
+# Static keyboards - built once at import instead of re-allocating and
+# re-validating the same markup on every handler invocation
+MAIN_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Subscribe", callback_data="subscribe")],
+    [InlineKeyboardButton(text="My Subscription", callback_data="subscription_status")],
+    [InlineKeyboardButton(text="Cancel Auto-Renewal", callback_data="cancel_auto_renewal")],
+])
+
+BACK_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Back to Menu", callback_data="back_to_menu")],
+])
+
+DEMO_SUCCESS_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📊 My Subscription", callback_data="subscription_status")],
+    [InlineKeyboardButton(text="Back to Menu", callback_data="back_to_menu")],
+])
+
+@functools.lru_cache(maxsize=256)
+def _payment_kb(payment_url: str) -> InlineKeyboardMarkup:
+    """Payment keyboard, cached per URL so repeat prompts skip the markup build."""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="💳 Pay Now", url=payment_url)],
+        [InlineKeyboardButton(text="Back to Menu", callback_data="back_to_menu")],
+    ])
+
+@functools.lru_cache(maxsize=64)
+def _reminder_kb(price: float) -> InlineKeyboardMarkup:
+    """Reminder keyboard, cached per price (only a handful of prices exist)."""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Pay Now", callback_data=f"pay_{price}")],
+    ])
+
+# Constant reply texts, built once at import; parametric ones are
+# templates filled in with .format on the request path
+_MSG_WELCOME = (
+    "Welcome to the Subscription Bot!\n\n"
+    "This bot helps you manage your subscription to our group."
+)
+_MSG_NO_SUBSCRIPTION = "🔴 **No active subscription**\n\nClick 'Subscribe' to get started."
+_MSG_AUTO_RENEWAL_OFF = "✅ **Auto-renewal disabled**\n\nSubscription remains active until end date."
+_MSG_AUTO_RENEWAL_OFF_SHORT = "✅ **Auto-renewal disabled**"
+_MSG_AUTO_RENEWAL_INACTIVE = "ℹ️ **Auto-renewal not active**"
+_MSG_GENERIC_ERROR = "❌ **Error**\n\nPlease try again later."
+_MSG_NO_PAYMENTS = "No payments yet."
+_MSG_DEMO_USAGE = "Usage: /demo_complete [payment_id]"
+_MSG_DEMO_INACTIVE = "Demo mode not active"
+_MSG_PAYMENT_PROMPT = "💰 Amount: {amount} {currency}\n🔄 Auto-renewal: enabled\n\nClick 'Pay Now' to complete payment."
+_MSG_PAYMENT_ERROR = "❌ Error: {error}\n\nPlease try again later."
 
 # Helper functions
-async def get_user_price(user_id: int) -> float:
-    """Get subscription price for user."""
+# Cache for price_config.json, invalidated when the file's mtime changes,
+# so the hot path (every /start, reminder and payment) avoids re-reading
+# and re-parsing the file on each call.
+_price_cache = {'mtime': 0, 'data': None}
+
+def _load_price_config() -> Optional[Dict[str, Any]]:
+    """Load price_config.json, re-reading only when the file changed on disk."""
     try:
-        with open('price_config.json', 'r') as f:
-            config = json.load(f)
-        user_prices = config.get('user_prices', {})
-        if str(user_id) in user_prices:
-            return float(user_prices[str(user_id)])
-        return float(config.get('default_price', os.getenv('DEFAULT_SUBSCRIPTION_PRICE', '9.99')))
+        mtime = os.stat('price_config.json').st_mtime_ns
     except FileNotFoundError:
-        return float(os.getenv('DEFAULT_SUBSCRIPTION_PRICE', '9.99'))
+        _price_cache['mtime'] = 0
+        _price_cache['data'] = None
+        return None
+
+    if _price_cache['data'] is None or mtime != _price_cache['mtime']:
+        with open('price_config.json', 'rb') as f:
+            raw = f.read()
+        _price_cache['data'] = orjson.loads(raw) if orjson else json.loads(raw)
+        _price_cache['mtime'] = mtime
+    return _price_cache['data']
+
+def _parse_amount(value: Union[int, float, str]) -> Union[int, float]:
+    """Parse a price value, accepting comma decimals ("99,99").
+
+    Whole-number strings take the int() fast path - cheaper than float()
+    and amounts like "100" stay exact instead of becoming 100.0.
+    """
+    if isinstance(value, (int, float)):
+        return value
+    s = value.strip().replace(',', '.')
+    if s.isdigit():
+        return int(s)
+    return float(s)
+
+async def get_user_price(user_id: int) -> float:
+    """Get subscription price for user."""
+    # File read happens in a worker thread so disk latency never blocks
+    # the event loop; on a cache hit no I/O happens at all.
+    config = await asyncio.to_thread(_load_price_config)
+    if config is None:
+        return DEFAULT_PRICE
+    user_prices = config.get('user_prices', {})
+    if str(user_id) in user_prices:
+        return _parse_amount(user_prices[str(user_id)])
+    return _parse_amount(config.get('default_price', DEFAULT_PRICE))
+
+def _event_timestamp(message: Optional[Message]) -> int:
+    """Payment timestamp taken from the update we already received.
+
+    The date is right there on the incoming message, so stamping a payment
+    never needs an extra Bot API round-trip.
+    """
+    if message and message.date:
+        return int(message.date.timestamp())
+    return int(time.time())
+
+async def _call_with_retry(fn, *args, attempts: int = 3, base_delay: float = 0.5, **kwargs):
+    """Call a provider coroutine, retrying transient network failures.
+
+    Exponential backoff (0.5s, 1s, 2s) caps the tail latency of a provider
+    hiccup instead of surfacing the very first timeout to the user.
+    """
+    for attempt in range(attempts):
+        try:
+            return await fn(*args, **kwargs)
+        except (asyncio.TimeoutError, ConnectionError, aiohttp.ClientError) as e:
+            if attempt == attempts - 1:
+                raise
+            delay = base_delay * (2 ** attempt)
+            logging.warning(f"Provider call failed ({e}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
 
 async def create_payment_link(user_id: int) -> Dict[str, Any]:
     """Create payment link via provider."""
     try:
         amount = await get_user_price(user_id)
-        currency = os.getenv('CURRENCY', 'USD')
-        
-        result = await payment_provider.create_subscription(
+
+        result = await _call_with_retry(
+            payment_provider.create_subscription,
             user_id=user_id,
             amount=amount,
-            currency=currency,
+            currency=CURRENCY,
             interval='month',
             description='Monthly Subscription',
             metadata={'user_id': user_id}
         )
         
-        return {'success': result.success, 'payment_url': result.payment_url, 'payment_id': result.payment_id, 'error': result.error}
+        # Include the amount so callers don't have to re-read the price config
+        return {'success': result.success, 'payment_url': result.payment_url, 'payment_id': result.payment_id, 'error': result.error, 'amount': amount}
     except Exception as e:
         logging.error(f"Error creating payment: {e}")
         return {'success': False, 'error': str(e)}
 
+# Short-lived cache in front of the DB so repeated button presses don't
+# hit SQLite on every callback. Entries expire after a minute, are
+# dropped eagerly whenever the subscription changes, and the LRU cap
+# keeps long-gone users from staying resident forever (same bound as
+# db.py's user cache).
+_STATUS_CACHE_TTL = 60
+_STATUS_CACHE_MAX = 1024
+_status_cache: "collections.OrderedDict[int, Tuple[float, Dict[str, Any]]]" = collections.OrderedDict()
+
+def _invalidate_status_cache(user_id: int):
+    """Drop the cached subscription status after a subscription change."""
+    _status_cache.pop(user_id, None)
+    _history_cache.pop(user_id, None)
+
+# Rendered /history text cached per user; the entry count doubles as the
+# cache key so a stale render can never survive a new payment, and the
+# LRU cap bounds residency the same way as the status cache above
+_HISTORY_LIMIT = 50
+_HISTORY_CACHE_MAX = 1024
+_history_cache: "collections.OrderedDict[int, Tuple[int, str]]" = collections.OrderedDict()
+
 async def check_subscription_status(user_id: int) -> Dict[str, Any]:
     """Check subscription status from database."""
+    cached = _status_cache.get(user_id)
+    if cached and time.monotonic() - cached[0] < _STATUS_CACHE_TTL:
+        _status_cache.move_to_end(user_id)
+        return cached[1]
     try:
-        user = await db.get_user(user_id)
+        # Narrow projection: entitlement flags only, no payment_history decode
+        user = await db.get_user_subscription_state(user_id)
         if not user or not user.get('subscription_active'):
-            return {'active': False}
-        
-        end_date = user.get('subscription_end_date')
-        if isinstance(end_date, str):
-            end_date = datetime.datetime.fromisoformat(end_date.replace('Z', '+00:00'))
-        
-        days_left = (end_date - datetime.datetime.now()).days if end_date else 0
-        
-        return {
-            'active': True,
-            'end_date': end_date,
-            'days_left': days_left,
-            'auto_renewal': user.get('auto_renewal', False)
-        }
+            status = {'active': False}
+        else:
+            end_ts = user.get('subscription_end_ts')
+            if end_ts:
+                # Epoch column: plain integer arithmetic, no ISO parsing
+                days_left = (int(end_ts) - int(time.time())) // 86400
+                end_date = datetime.datetime.fromtimestamp(int(end_ts))
+            else:
+                end_date = user.get('subscription_end_date')
+                if isinstance(end_date, str):
+                    end_date = datetime.datetime.fromisoformat(end_date.replace('Z', '+00:00'))
+                days_left = (end_date - datetime.datetime.now()).days if end_date else 0
+
+            status = {
+                'active': True,
+                'end_date': end_date,
+                'days_left': days_left,
+                'auto_renewal': user.get('auto_renewal', False)
+            }
+        _status_cache[user_id] = (time.monotonic(), status)
+        _status_cache.move_to_end(user_id)
+        while len(_status_cache) > _STATUS_CACHE_MAX:
+            _status_cache.popitem(last=False)
+        return status
     except Exception as e:
         logging.error(f"Error checking subscription: {e}")
         return {'active': False}
 
+# Outgoing messages from bulk jobs (reminders, kick notices) go through a
+# queue drained by a single worker, paced below Telegram's 30 msg/s global
+# limit so bursts never trigger 429 retry-after cascades
+_SEND_INTERVAL = 1 / 30
+_send_queue: asyncio.Queue = asyncio.Queue()
+
+async def queue_message(user_id: int, text: str, **kwargs):
+    """Queue an outgoing message for rate-limited delivery."""
+    await _send_queue.put((user_id, dict(text=text, **kwargs)))
+
+async def _sender_worker():
+    """Drain the outgoing queue, pacing sends below the Telegram global limit."""
+    last_send = 0.0
+    while True:
+        user_id, kwargs = await _send_queue.get()
+        delay = last_send + _SEND_INTERVAL - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            await bot.send_message(user_id, **kwargs)
+        except Exception as e:
+            logging.error(f"Failed to send queued message to user {user_id}: {e}")
+        last_send = time.monotonic()
+        _send_queue.task_done()
+
 async def send_payment_reminder(user_id: int, days_left: int):
     """Send a payment reminder to the user."""
     price = await get_user_price(user_id)
-    message = f"Your subscription will expire in {days_left} day{'s' if days_left > 1 else ''}. "
-    message += f"The renewal price is {price} rubles."
-    
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("Pay Now", callback_data=f"pay_{price}"))
-    
-    try:
-        await bot.send_message(user_id, message, reply_markup=keyboard)
-    except Exception as e:
-        logging.error(f"Failed to send reminder to user {user_id}: {e}")
+    message = (
+        f"Your subscription will expire in {days_left} day{'s' if days_left > 1 else ''}. "
+        f"The renewal price is {price} rubles."
+    )
+
+    await queue_message(user_id, message, reply_markup=_reminder_kb(price))
 
 async def check_and_remove_unpaid_users():
     """Check for users who haven't paid in 2 days after expiration and remove them from the group."""
     users_to_kick = await db.get_expired_users_to_kick(days_threshold=2)
-    
-    for user_id in users_to_kick:
-        try:
-            # Remove user from the group
-            await bot.kick_chat_member(GROUP_ID, user_id)
-            # Mark user as left in the database
-            await db.set_user_left_group(user_id, True)
-            logging.info(f"User {user_id} removed from group due to non-payment")
-        except Exception as e:
-            # Log error but continue processing other users
-            logging.error(f"Failed to remove user {user_id} from group: {e}")
+    if not users_to_kick:
+        return
+
+    # Kick concurrently, capped below Telegram's 30 req/s global limit
+    sem = asyncio.Semaphore(25)
+
+    async def _kick_one(user_id: int) -> Optional[int]:
+        async with sem:
+            try:
+                await bot.ban_chat_member(GROUP_ID, user_id)
+                logging.info(f"User {user_id} removed from group due to non-payment")
+                return user_id
+            except Exception as e:
+                # Log error but continue processing other users
+                logging.error(f"Failed to remove user {user_id} from group: {e}")
+                return None
+
+    results = await asyncio.gather(*[_kick_one(uid) for uid in users_to_kick])
+    kicked = [uid for uid in results if uid is not None]
+
+    # Mark all successfully kicked users as left in one DB round-trip
+    if kicked:
+        await db.set_users_left_group(kicked, True)
 
 async def scheduled_tasks():
-    """Run scheduled tasks."""
+    """Run scheduled tasks once a day, correcting for drift."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time()
     while True:
+        # Advance the deadline first so a slow run doesn't push every
+        # following run later by its own duration
+        deadline += 86400
         try:
             await check_and_remove_unpaid_users()
         except Exception as e:
             logging.error(f"Error in scheduled_tasks: {e}")
-        await asyncio.sleep(86400)
+        # Random jitter keeps multiple bot replicas from hitting the DB
+        # at the exact same moment
+        await asyncio.sleep(max(0, deadline - loop.time()) + random.uniform(0, 300))
 
 # Price configuration commands
-# Note: The following handlers use aiogram 2.x syntax which is incompatible with 3.x
-# For testing purposes, we'll define them but not register them during import
-def register_handlers(dp):
-    """Register all bot handlers - call this function to register handlers properly."""
-    dp.message.register(set_price_command, commands=['set_price'])
-    dp.message.register(cmd_start, commands=['start'])
-    dp.callback_query.register(process_subscription, lambda c: c.data == 'subscribe', state=UserStates.main_menu)
-    dp.callback_query.register(show_subscription_status, lambda c: c.data == 'subscription_status', state=UserStates.main_menu)
-    dp.callback_query.register(cancel_auto_renewal, lambda c: c.data == 'cancel_auto_renewal', state=UserStates.main_menu)
-    dp.callback_query.register(back_to_menu, lambda c: c.data == 'back_to_menu', state='*')
-    dp.message.register(demo_complete, commands=['demo_complete'])
-
-
-async def set_price_command(message: types.Message):
+@router.message(Command('set_price'))
+async def set_price_command(message: types.Message, command: Optional[CommandObject] = None):
     """Handle price updates from admins."""
     try:
-        args = message.get_args().split()
+        args = command.args.split() if command and command.args else []
         if len(args) != 2:
             raise ValueError("Requires 2 arguments: regular_price returning_price")
 
@@ -191,8 +406,17 @@ async def set_price_command(message: types.Message):
         if regular <= 0 or returning <= 0:
             raise ValueError("Prices must be positive integers")
 
-        with open('price_config.json', 'w') as f:
-            json.dump({'regular_price': regular, 'returning_price': returning}, f)
+        def _write_config():
+            data = {'regular_price': regular, 'returning_price': returning}
+            if orjson:
+                with open('price_config.json', 'wb') as f:
+                    f.write(orjson.dumps(data))
+            else:
+                with open('price_config.json', 'w') as f:
+                    json.dump(data, f)
+
+        # Write in a worker thread to keep the event loop responsive
+        await asyncio.to_thread(_write_config)
 
         await message.answer(f"✅ Prices updated:\nRegular: {regular} RUB\nReturning: {returning} RUB")
     except Exception as e:
@@ -200,86 +424,60 @@ async def set_price_command(message: types.Message):
         await message.answer(f"❌ Error: {str(e)}")
 
 # Command handlers
+@router.message(Command('start'))
 async def cmd_start(message: types.Message, state: Optional[FSMContext] = None):
     """Handle the /start command - introduce the bot and show main menu."""
     user_id = message.from_user.id
-    
-    # Check if user exists, if not, add them
-    user = await db.get_user(user_id)
-    if not user:
-        await db.add_or_update_user(user_id, {
-            'subscription_active': False,
-            'subscription_end_date': None,
-            'auto_renewal': False,
-            'left_group': False,
-            'payment_history': [] # Initialize with empty history
-        })
+
+    # Register the user in one idempotent statement - no SELECT round-trip
+    # and nothing to overwrite when they already exist
+    if await db.ensure_user(user_id):
         logging.info(f"New user {user_id} added to database.")
-    
-    keyboard = InlineKeyboardMarkup(row_width=1)
-    keyboard.add(
-        InlineKeyboardButton("Subscribe", callback_data="subscribe"),
-        InlineKeyboardButton("My Subscription", callback_data="subscription_status"),
-        InlineKeyboardButton("Cancel Auto-Renewal", callback_data="cancel_auto_renewal")
-    )
-    
-    await message.answer(
-        "Welcome to the Subscription Bot!\n\n"
-        "This bot helps you manage your subscription to our group.",
-        reply_markup=keyboard
-    )
+
+    await message.answer(_MSG_WELCOME, reply_markup=MAIN_MENU_KB)
     await _set_state_safe(state, UserStates.main_menu)
 
+@router.callback_query(F.data == 'subscribe', StateFilter(UserStates.main_menu))
 async def process_subscription(callback_query: CallbackQuery, state: FSMContext):
     """Process subscription request."""
     user_id = callback_query.from_user.id
-    
+
+    # Demo mode is known at startup: activate directly and skip the
+    # provider round-trip whose payment_url would be discarded anyway
+    if DEMO_MODE:
+        amount = await get_user_price(user_id)
+        end_date = datetime.datetime.now() + datetime.timedelta(days=30)
+        await db.update_user_subscription(
+            user_id,
+            is_active=True,
+            end_date=end_date,
+            auto_renewal=True,
+            payment_info={'amount': amount, 'currency': CURRENCY, 'date': _event_timestamp(callback_query.message)}
+        )
+        _invalidate_status_cache(user_id)
+
+        message_text = f"✅ Subscription activated!\n\n💰 Amount: {amount} {CURRENCY}\n📅 Valid until: {end_date.strftime('%Y-%m-%d')}\n🔄 Auto-renewal: enabled\n\n🎭 Demo mode - no real payment required"
+
+        await _edit_or_send(callback_query, message_text, DEMO_SUCCESS_KB)
+        await _set_state_safe(state, UserStates.main_menu)
+        return
+
     result = await create_payment_link(user_id)
 
     if result['success']:
-        amount = await get_user_price(user_id)
-        currency = os.getenv('CURRENCY', 'USD')
-        
-        # Check if demo mode - auto-activate subscription
-        if os.getenv('PAYMENT_PROVIDER', 'demo').lower() == 'demo':
-            end_date = datetime.datetime.now() + datetime.timedelta(days=30)
-            await db.update_user_subscription(
-                user_id,
-                is_active=True,
-                end_date=end_date,
-                auto_renewal=True
-            )
-            
-            keyboard = InlineKeyboardMarkup()
-            keyboard.add(InlineKeyboardButton("📊 My Subscription", callback_data="subscription_status"))
-            keyboard.add(InlineKeyboardButton("Back to Menu", callback_data="back_to_menu"))
-            
-            message_text = f"✅ Subscription activated!\n\n💰 Amount: {amount} {currency}\n📅 Valid until: {end_date.strftime('%Y-%m-%d')}\n🔄 Auto-renewal: enabled\n\n🎭 Demo mode - no real payment required"
-        else:
-            keyboard = InlineKeyboardMarkup(row_width=1)
-            keyboard.add(
-                InlineKeyboardButton("💳 Pay Now", url=result['payment_url']),
-                InlineKeyboardButton("Back to Menu", callback_data="back_to_menu")
-            )
-            message_text = f"💰 Amount: {amount} {currency}\n🔄 Auto-renewal: enabled\n\nClick 'Pay Now' to complete payment."
-        
-        try:
-            await callback_query.message.edit_text(message_text, reply_markup=keyboard)
-        except Exception:
-            await bot.send_message(user_id, message_text, reply_markup=keyboard)
-            
+        amount = result['amount']
+
+        message_text = _MSG_PAYMENT_PROMPT.format(amount=amount, currency=CURRENCY)
+
+        await _edit_or_send(callback_query, message_text, _payment_kb(result['payment_url']))
         await _set_state_safe(state, UserStates.main_menu)
     else:
-        keyboard = InlineKeyboardMarkup()
-        keyboard.add(InlineKeyboardButton("Back to Menu", callback_data="back_to_menu"))
-        message_text = f"❌ Error: {result.get('error', 'Unknown error')}\n\nPlease try again later."
-        
-        try:
-            await callback_query.message.edit_text(message_text, reply_markup=keyboard)
-        except Exception:
-            await bot.send_message(user_id, message_text, reply_markup=keyboard)
+        message_text = _MSG_PAYMENT_ERROR.format(error=result.get('error', 'Unknown error'))
+
+        await _edit_or_send(callback_query, message_text, BACK_KB)
         await _set_state_safe(state, UserStates.main_menu)
 
+@router.callback_query(F.data == 'subscription_status', StateFilter(UserStates.main_menu))
 async def show_subscription_status(callback_query: CallbackQuery, state: FSMContext):
     """Show subscription status."""
     user_id = callback_query.from_user.id
@@ -290,21 +488,18 @@ async def show_subscription_status(callback_query: CallbackQuery, state: FSMCont
         end_date_str = end_date.strftime('%d.%m.%Y %H:%M') if end_date else 'Unknown'
         days_left = status.get('days_left', 0)
         
-        message = f"🟢 **Subscription Active**\n\n"
-        message += f"📅 **Valid until:** {end_date_str}\n"
-        message += f"⏰ **Days remaining:** {days_left}\n"
-        message += f"🔄 **Auto-renewal:** {'enabled' if status.get('auto_renewal') else 'disabled'}"
+        message = (
+            f"🟢 **Subscription Active**\n\n"
+            f"📅 **Valid until:** {end_date_str}\n"
+            f"⏰ **Days remaining:** {days_left}\n"
+            f"🔄 **Auto-renewal:** {'enabled' if status.get('auto_renewal') else 'disabled'}"
+        )
     else:
-        message = "🔴 **No active subscription**\n\nClick 'Subscribe' to get started."
-    
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("Back to Menu", callback_data="back_to_menu"))
-    
-    try:
-        await callback_query.message.edit_text(message, reply_markup=keyboard, parse_mode='Markdown')
-    except Exception:
-        await bot.send_message(user_id, message, reply_markup=keyboard, parse_mode='Markdown')
+        message = _MSG_NO_SUBSCRIPTION
+
+    await _edit_or_send(callback_query, message, BACK_KB, parse_mode='Markdown')
 
+@router.callback_query(F.data == 'cancel_auto_renewal', StateFilter(UserStates.main_menu))
 async def cancel_auto_renewal(callback_query: CallbackQuery, state: FSMContext):
     """Cancel auto-renewal."""
     user_id = callback_query.from_user.id
@@ -323,7 +518,8 @@ async def cancel_auto_renewal(callback_query: CallbackQuery, state: FSMContext):
                         end_date=user.get('subscription_end_date'), 
                         auto_renewal=False
                     )
-                    message = "✅ **Auto-renewal disabled**\n\nSubscription remains active until end date."
+                    _invalidate_status_cache(user_id)
+                    message = _MSG_AUTO_RENEWAL_OFF
                 else:
                     message = f"❌ **Error:** {result.error}"
             else:
@@ -333,30 +529,74 @@ async def cancel_auto_renewal(callback_query: CallbackQuery, state: FSMContext):
                     end_date=user.get('subscription_end_date'), 
                     auto_renewal=False
                 )
-                message = "✅ **Auto-renewal disabled**"
+                _invalidate_status_cache(user_id)
+                message = _MSG_AUTO_RENEWAL_OFF_SHORT
         except Exception as e:
             logging.error(f"Error cancelling auto-renewal: {e}")
-            message = "❌ **Error**\n\nPlease try again later."
+            message = _MSG_GENERIC_ERROR
     else:
-        message = "ℹ️ **Auto-renewal not active**"
-    
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("Back to Menu", callback_data="back_to_menu"))
-    
-    try:
-        await callback_query.message.edit_text(message, reply_markup=keyboard, parse_mode='Markdown')
-    except Exception:
-        await bot.send_message(user_id, message, reply_markup=keyboard, parse_mode='Markdown')
+        message = _MSG_AUTO_RENEWAL_INACTIVE
 
+    await _edit_or_send(callback_query, message, BACK_KB, parse_mode='Markdown')
+
+@router.callback_query(F.data == 'back_to_menu')
 async def back_to_menu(callback_query: CallbackQuery, state: FSMContext):
     """Return to the main menu."""
     await cmd_start(callback_query.message)
 
 
-async def demo_complete(message: types.Message):
+@router.message(Command('history'))
+async def payment_history(message: types.Message):
+    """Show the user's most recent payments."""
+    user_id = message.from_user.id
+    user = await db.get_user(user_id)
+
+    raw = user.get('payment_history') if user else None
+    try:
+        payments = json.loads(raw) if isinstance(raw, str) else (raw or [])
+    except ValueError:
+        payments = []
+
+    if not payments:
+        await message.answer(_MSG_NO_PAYMENTS)
+        return
+
+    cached = _history_cache.get(user_id)
+    if cached and cached[0] == len(payments):
+        _history_cache.move_to_end(user_id)
+        text = cached[1]
+    else:
+        # Newest first, capped at _HISTORY_LIMIT; one join instead of
+        # quadratic string concatenation over the whole history
+        lines = []
+        for i, p in enumerate(reversed(payments[-_HISTORY_LIMIT:]), 1):
+            # Demo payments store epoch seconds, Telegram-native payments
+            # store ISO strings; render both and skip malformed entries
+            paid_at = p.get('date')
+            try:
+                if isinstance(paid_at, str):
+                    when = datetime.datetime.fromisoformat(paid_at).strftime('%d.%m.%Y')
+                elif paid_at:
+                    when = datetime.datetime.fromtimestamp(paid_at).strftime('%d.%m.%Y')
+                else:
+                    when = 'unknown date'
+            except (ValueError, TypeError, OverflowError, OSError):
+                when = 'unknown date'
+            lines.append(f"{i}. {p.get('amount', '?')} {p.get('currency', CURRENCY)} - {when}")
+        text = "📊 Payment history:\n" + "\n".join(lines)
+        _history_cache[user_id] = (len(payments), text)
+        _history_cache.move_to_end(user_id)
+        while len(_history_cache) > _HISTORY_CACHE_MAX:
+            _history_cache.popitem(last=False)
+
+    await message.answer(text)
+
+
+@router.message(Command('demo_complete'))
+async def demo_complete(message: types.Message, command: Optional[CommandObject] = None):
     """Complete demo payment (demo mode only)."""
     if hasattr(payment_provider, 'complete_demo_payment'):
-        args = message.get_args().split()
+        args = command.args.split() if command and command.args else []
         if args:
             payment_id = args[0]
             result = await payment_provider.complete_demo_payment(payment_id)
@@ -364,49 +604,76 @@ async def demo_complete(message: types.Message):
             if result['success']:
                 user_id = message.from_user.id
                 end_date = datetime.datetime.now() + datetime.timedelta(days=30)
-                
+
+                paid = result.get('payment') or result.get('subscription') or {}
                 await db.update_user_subscription(
                     user_id,
                     is_active=True,
                     end_date=end_date,
-                    auto_renewal=True
+                    auto_renewal=True,
+                    payment_info={'amount': paid.get('amount'), 'currency': paid.get('currency', CURRENCY), 'date': _event_timestamp(message)}
                 )
-                
+                _invalidate_status_cache(user_id)
+
                 await message.answer(f"✅ Payment completed!\n\nSubscription active until {end_date.strftime('%Y-%m-%d')}")
             else:
                 await message.answer(f"❌ {result['error']}")
         else:
-            await message.answer("Usage: /demo_complete [payment_id]")
+            await message.answer(_MSG_DEMO_USAGE)
     else:
-        await message.answer("Demo mode not active")
+        await message.answer(_MSG_DEMO_INACTIVE)
 
 
-async def on_startup(dp: Dispatcher):
+async def on_startup():
     """Bot startup."""
     logging.info(f"Starting bot with {payment_provider.__class__.__name__}...")
+    # aiosqlite runs all SQLite calls in its own thread, so nothing here
+    # blocks the event loop; the explicit commit was redundant (init only
+    # runs PRAGMAs and DDL, which commit themselves)
     await db.init_db_pool()
-    await db.conn.commit()
+    # Prime DNS + TLS to api.telegram.org so the first real send (often a
+    # cold bulk sweep) doesn't pay the handshake
+    await bot.get_me()
+    asyncio.create_task(_sender_worker())
     asyncio.create_task(scheduled_tasks())
     logging.info("Bot started")
 
-async def on_shutdown(dp: Dispatcher):
+async def on_shutdown():
     """Bot shutdown."""
     logging.info("Shutting down...")
+    await PaymentProvider.close_http()
     await db.close_db_pool()
     logging.info("Bot stopped")
 
+# Register on the dispatcher so both run modes fire the hooks: polling
+# dispatches them around start_polling, webhook mode via setup_application
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
 
 if __name__ == '__main__':
-    import asyncio
-    from aiogram import Bot, Dispatcher
-    from aiogram.fsm.storage.memory import MemoryStorage
+    try:
+        # Optional: 2-4x faster event loop for asyncio-heavy handlers
+        # (Linux/macOS only - uvloop is not available on Windows, where the
+        # default selector policy is used instead)
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
 
-    # Create bot instance
-    bot = Bot(token=API_TOKEN)
-    dp = Dispatcher(storage=MemoryStorage())
+    if USE_WEBHOOK and WEBHOOK_URL:
+        # Webhook mode: Telegram pushes updates to us, removing the
+        # getUpdates round-trip latency of long polling
+        from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
-    # Register handlers
-    register_handlers(dp)
+        async def _set_webhook(app):
+            await bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
 
-    # Run the bot
-    asyncio.run(dp.start_polling(bot, skip_updates=True))
+        app = web.Application()
+        SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
+        app.on_startup.append(_set_webhook)
+        web.run_app(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+    else:
+        # Run the bot with long polling
+        asyncio.run(dp.start_polling(bot, skip_updates=True))
@@ -25,6 +25,10 @@ def get_payment_provider() -> PaymentProvider:
     if provider_type == 'demo':
         return DemoPaymentProvider(bot_username=bot_username)
     
+    elif provider_type == 'prodamus':
+        from payment_providers.prodamus import ProdamusPaymentProvider
+        return ProdamusPaymentProvider()
+
     # Uncomment and configure when ready to use Stripe:
     # elif provider_type == 'stripe':
     #     from payment_providers.stripe_example import StripePaymentProvider
@@ -1,7 +1,11 @@
 import os
 import json
+import time
 import logging
 import datetime
+import collections
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from typing import Dict, List, Optional, Tuple, Any
 
 import sqlite3
@@ -14,39 +18,130 @@ load_dotenv()
 # Database Configuration - SQLite: No credentials needed
 DB_FILE = 'bot_database.db' # SQLite database file
 
-# Global connection pool (for SQLite, it's simpler to manage a single connection)
+# Number of pooled read connections (WAL allows them to run concurrently)
+READ_POOL_SIZE = 4
+
+# Global pool plus the writer connection under its legacy name `conn`
 conn = None
+pool = None
 _db_lock = None
 
-async def init_db_pool(): # Renamed to init_db_connection for SQLite
-    """Initialize the database connection."""
-    global conn, _db_lock
+# Connection bound to the current asyncio task. Nested acquire_* calls in
+# the same task reuse it, so a multi-step write sequence stays on one
+# connection (and one transaction) instead of interleaving with other tasks.
+_current_conn: "ContextVar[Optional[aiosqlite.Connection]]" = ContextVar("current_conn", default=None)
+
+
+async def _open_connection(db_file: str) -> aiosqlite.Connection:
+    """Open a SQLite connection with the standard PRAGMA preamble applied."""
+    c = await aiosqlite.connect(db_file)
+    c.row_factory = aiosqlite.Row  # Name-addressable rows without per-call zip(description)
+    await c.execute("PRAGMA journal_mode=WAL;")  # Enable WAL mode for better concurrency
+    await c.execute("PRAGMA busy_timeout = 10000;") # Set timeout to 10 seconds (milliseconds)
+    # Write-light, latency-sensitive workload: partial syncs are safe
+    # under WAL and avoid a full fsync per commit
+    await c.execute("PRAGMA synchronous=NORMAL;")
+    await c.execute("PRAGMA temp_store=MEMORY;") # Keep temp tables/indices off disk
+    await c.execute("PRAGMA cache_size=-64000;") # 64 MB page cache (negative = KB)
+    await c.execute("PRAGMA mmap_size=268435456;") # Memory-map up to 256 MB of the DB file
+    return c
+
+
+class ConnectionPool:
+    """Pool of read connections plus one dedicated writer.
+
+    WAL mode lets any number of readers run alongside a single writer, so
+    SELECT-heavy sweeps no longer serialize behind each other on one
+    shared connection.
+    """
+
+    def __init__(self, db_file: str, readers: int = READ_POOL_SIZE):
+        import asyncio
+        self._db_file = db_file
+        self._readers = readers
+        self._read_q: "asyncio.Queue[aiosqlite.Connection]" = asyncio.Queue()
+        self._write_lock = asyncio.Lock()
+        self.writer: Optional[aiosqlite.Connection] = None
+
+    async def init(self):
+        """Open the writer and all pooled read connections."""
+        self.writer = await _open_connection(self._db_file)
+        for _ in range(self._readers):
+            await self._read_q.put(await _open_connection(self._db_file))
+
+    @asynccontextmanager
+    async def acquire_read(self):
+        """Borrow a read connection from the pool.
+
+        Reuses the task's current connection when one is already held, so
+        nested calls share a connection instead of deadlocking on the pool.
+        """
+        existing = _current_conn.get()
+        if existing is not None:
+            yield existing
+            return
+        c = await self._read_q.get()
+        token = _current_conn.set(c)
+        try:
+            yield c
+        finally:
+            _current_conn.reset(token)
+            self._read_q.put_nowait(c)
+
+    @asynccontextmanager
+    async def acquire_write(self):
+        """Acquire the single writer connection (serialized by a lock)."""
+        if _current_conn.get() is self.writer and self.writer is not None:
+            # Already inside a write scope on this task
+            yield self.writer
+            return
+        async with self._write_lock:
+            token = _current_conn.set(self.writer)
+            try:
+                yield self.writer
+            finally:
+                _current_conn.reset(token)
+
+    async def close(self):
+        """Close the writer and all pooled read connections."""
+        if self.writer:
+            await self.writer.close()
+            self.writer = None
+        while not self._read_q.empty():
+            c = self._read_q.get_nowait()
+            await c.close()
+
+
+async def init_db_pool():
+    """Initialize the database connection pool."""
+    global conn, pool, _db_lock
     import asyncio
-    
+
     if _db_lock is None:
         _db_lock = asyncio.Lock()
-    
+
     async with _db_lock:
-        if conn is not None:
+        if conn is not None and pool is not None:
             return  # Already initialized
-        
+
         try:
-            conn = await aiosqlite.connect(DB_FILE) # Connect to SQLite file
-            await conn.execute("PRAGMA journal_mode=WAL;")  # Enable WAL mode for better concurrency
-            await conn.execute("PRAGMA busy_timeout = 10000;") # Set timeout to 10 seconds (milliseconds)
-            logging.info("SQLite database connection established with WAL mode.")
+            pool = ConnectionPool(DB_FILE)
+            await pool.init()
+            conn = pool.writer  # Legacy name: the writer connection
+            logging.info("SQLite connection pool established with WAL mode.")
             await setup_database()
         except Exception as e:
             logging.error(f"Failed to create SQLite database connection: {e}")
             raise
 
-async def close_db_pool(): # Renamed to close_db_connection for SQLite
-    """Close the database connection."""
-    global conn
-    if conn:
-        await conn.close()
+async def close_db_pool():
+    """Close the database connections."""
+    global conn, pool
+    if pool:
+        await pool.close()
+        pool = None
         conn = None  # Reset global connection variable
-        logging.info("SQLite database connection closed.")
+        logging.info("SQLite connection pool closed.")
 
 async def setup_database():
     """Create necessary tables if they don't exist."""
@@ -57,6 +152,7 @@ async def setup_database():
                     user_id INTEGER PRIMARY KEY, -- Changed to INTEGER for SQLite
                     subscription_active BOOLEAN DEFAULT FALSE,
                     subscription_end_date DATETIME NULL,
+                    subscription_end_ts INTEGER NULL, -- Epoch seconds, cheap integer math on hot reads
                     auto_renewal BOOLEAN DEFAULT FALSE,
                     left_group BOOLEAN DEFAULT FALSE,
                     payment_history TEXT NULL, -- TEXT for JSON in SQLite
@@ -64,32 +160,136 @@ async def setup_database():
                     updated_at DATETIME DEFAULT CURRENT_TIMESTAMP -- DATETIME for SQLite
                 );
             """)
+            try:
+                # Databases created before the epoch column existed
+                await cur.execute("ALTER TABLE users ADD COLUMN subscription_end_ts INTEGER NULL;")
+            except Exception:
+                pass  # Column already present
+            try:
+                # Tariff/payment-method state for Telegram-native payments
+                await cur.execute("ALTER TABLE users ADD COLUMN user_data TEXT NULL;")
+            except Exception:
+                pass  # Column already present
+            # Partial indexes turn the reminder and kick sweeps from full
+            # table scans into index range seeks
+            await cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_users_end_date
+                ON users(subscription_end_date) WHERE subscription_active = 1;
+            """)
+            await cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_users_expired
+                ON users(subscription_end_ts) WHERE subscription_active = 0 AND left_group = 0;
+            """)
             logging.info("Checked/Created 'users' table in SQLite database.")
         except Exception as e:
             logging.error(f"Error setting up database tables in SQLite: {e}")
             raise
 
+def _to_epoch(value: Any) -> Optional[int]:
+    """Convert a datetime/ISO string/epoch value to epoch seconds."""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        try:
+            value = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    return int(value.timestamp())
+
+# Short-TTL LRU cache for get_user: handlers often fetch the same user
+# several times per update cycle (auth check, entitlement check, render).
+# Every write path evicts the touched user, so staleness is bounded by
+# the TTL only for out-of-band DB edits.
+_USER_CACHE_TTL = 2.0
+_USER_CACHE_MAX = 1024
+_user_cache: "collections.OrderedDict[int, Tuple[float, Dict[str, Any]]]" = collections.OrderedDict()
+
+def _evict_user_cache(user_id: int):
+    """Drop a user's cached row after a write."""
+    _user_cache.pop(user_id, None)
+
+SQL_GET_USER = "SELECT * FROM users WHERE user_id = ?"
+
+SQL_GET_SUBSCRIPTION_STATE = """
+    SELECT subscription_active, subscription_end_date, subscription_end_ts, auto_renewal, left_group
+    FROM users WHERE user_id = ?
+"""
+
+async def get_user_subscription_state(user_id: int) -> Optional[Dict[str, Any]]:
+    """Fetch only the entitlement columns for a user.
+
+    Status checks don't need payment_history, so this avoids decoding the
+    JSON column (and the associated allocations) on every button press.
+    """
+    if not conn: await init_db_pool()
+    async with pool.acquire_read() as rc:
+        async with rc.cursor() as cur:
+            await cur.execute(SQL_GET_SUBSCRIPTION_STATE, (user_id,))
+            row = await cur.fetchone()
+            if row is None:
+                return None
+            state = dict(row)
+            for key in ("subscription_active", "auto_renewal", "left_group"):
+                if state[key] is not None:
+                    state[key] = bool(state[key])
+            return state
+
 async def get_user(user_id: int) -> Optional[Dict[str, Any]]:
     """Fetch user data from the database."""
-    if not conn: await init_db_pool() # Ensure connection is initialized
-    async with conn.cursor() as cur:
-        await cur.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) # SQLite uses ? placeholders
-        row = await cur.fetchone()
-        if row:
-            columns = [col[0] for col in cur.description]
-            user = dict(zip(columns, row))
-            for key in ("subscription_active", "auto_renewal", "left_group"):
-                if key in user and user[key] is not None:
-                    user[key] = bool(user[key])
-            if user.get('payment_history'):
-                # Deserialize JSON string back to Python list
-                try:
-                    user['payment_history'] = json.loads(user['payment_history'])
-                except (json.JSONDecodeError, TypeError):
-                    logging.warning(f"Could not decode payment_history for user {user_id}")
-                    user['payment_history'] = [] # Default to empty list on error
-            return user
-        return None
+    now = time.monotonic()
+    cached = _user_cache.get(user_id)
+    if cached and now - cached[0] < _USER_CACHE_TTL:
+        _user_cache.move_to_end(user_id)
+        return dict(cached[1])  # Shallow copy so callers can't mutate the cache
+    if not conn: await init_db_pool() # Ensure pool is initialized
+    async with pool.acquire_read() as rc:
+        async with rc.cursor() as cur:
+            await cur.execute(SQL_GET_USER, (user_id,)) # SQLite uses ? placeholders
+            row = await cur.fetchone()
+            if row:
+                user = dict(row)
+                for key in ("subscription_active", "auto_renewal", "left_group"):
+                    if key in user and user[key] is not None:
+                        user[key] = bool(user[key])
+                if user.get('payment_history'):
+                    # Deserialize JSON string back to Python list
+                    try:
+                        user['payment_history'] = json.loads(user['payment_history'])
+                    except (json.JSONDecodeError, TypeError):
+                        logging.warning(f"Could not decode payment_history for user {user_id}")
+                        user['payment_history'] = [] # Default to empty list on error
+                _user_cache[user_id] = (now, user)
+                _user_cache.move_to_end(user_id)
+                while len(_user_cache) > _USER_CACHE_MAX:
+                    _user_cache.popitem(last=False)
+                return dict(user)
+            return None
+
+# Registration is a single idempotent INSERT: for existing users SQLite
+# touches no pages, so the /start happy path costs one statement instead
+# of a SELECT followed by a conditional upsert
+SQL_ENSURE_USER = """
+    INSERT OR IGNORE INTO users (user_id, subscription_active, auto_renewal, left_group, payment_history)
+    VALUES (?, 0, 0, 0, '[]');
+"""
+
+async def ensure_user(user_id: int) -> bool:
+    """Register the user if missing. Returns True when newly created."""
+    if not conn: await init_db_pool()
+    async with pool.acquire_write() as wc:
+        async with wc.cursor() as cur:
+            await cur.execute(SQL_ENSURE_USER, (user_id,))
+            created = cur.rowcount > 0
+            await wc.commit()
+    if created:
+        _evict_user_cache(user_id)
+    return created
+
+# Upsert SQL cache keyed by column tuple - rebuilding the statement string
+# on every call is wasted work since the key shapes are few and stable
+_upsert_sql_cache: Dict[Tuple[str, ...], str] = {}
 
 async def add_or_update_user(user_id: int, data: Dict[str, Any]):
     """Add a new user or update an existing one."""
@@ -99,137 +299,309 @@ async def add_or_update_user(user_id: int, data: Dict[str, Any]):
     if 'payment_history' in data and isinstance(data['payment_history'], list):
         data['payment_history'] = json.dumps(data['payment_history'])
 
-    fields = ', '.join([f"{key} = ?" for key in data.keys()]) # SQLite uses ? placeholders
+    keys = tuple(data.keys())
     values = list(data.values())
 
-    sql = f"""
-        INSERT INTO users (user_id, {', '.join(data.keys())})
-        VALUES (?, {', '.join(['?'] * len(data))})
-        ON CONFLICT(user_id) DO UPDATE SET {', '.join([f"{key}=?" for key in data.keys()])}, updated_at = CURRENT_TIMESTAMP; -- SQLite ON CONFLICT syntax
+    sql = _upsert_sql_cache.get(keys)
+    if sql is None:
+        # excluded.<col> binds each value exactly once, instead of the old
+        # form that repeated the parameter list for the DO UPDATE clause
+        updates = ', '.join(f"{key}=excluded.{key}" for key in keys)
+        sql = f"""
+        INSERT INTO users (user_id, {', '.join(keys)})
+        VALUES (?, {', '.join(['?'] * len(keys))})
+        ON CONFLICT(user_id) DO UPDATE SET {updates}, updated_at = CURRENT_TIMESTAMP; -- SQLite ON CONFLICT syntax
     """
+        _upsert_sql_cache[keys] = sql
 
-    async with conn.cursor() as cur:
-        try:
-            await cur.execute(sql, [user_id] + values + values) # Flatten values list
-            await conn.commit()  # Commit changes
-            logging.debug(f"User {user_id} added or updated in SQLite.")
-        except Exception as e:
-            logging.error(f"Error adding/updating user {user_id} in SQLite: {e}")
-            raise
+    async with pool.acquire_write() as wc:
+        async with wc.cursor() as cur:
+            try:
+                await cur.execute(sql, [user_id] + values)
+                await wc.commit()  # Commit changes
+                _evict_user_cache(user_id)
+                logging.debug(f"User {user_id} added or updated in SQLite.")
+            except Exception as e:
+                logging.error(f"Error adding/updating user {user_id} in SQLite: {e}")
+                raise
+
+SQL_UPDATE_SUBSCRIPTION = """
+    INSERT INTO users (user_id, subscription_active, subscription_end_date, subscription_end_ts, auto_renewal, payment_history)
+    VALUES (?, ?, ?, ?, ?, CASE WHEN ? IS NULL THEN '[]' ELSE json_array(json(?)) END)
+    ON CONFLICT(user_id) DO UPDATE SET
+        subscription_active = excluded.subscription_active,
+        subscription_end_date = excluded.subscription_end_date,
+        subscription_end_ts = excluded.subscription_end_ts,
+        auto_renewal = excluded.auto_renewal,
+        payment_history = CASE WHEN ? IS NULL THEN users.payment_history
+            ELSE json_insert(COALESCE(users.payment_history, '[]'), '$[#]', json(?)) END,
+        updated_at = CURRENT_TIMESTAMP;
+"""
 
 async def update_user_subscription(user_id: int, is_active: bool, end_date: Optional[datetime.datetime], auto_renewal: bool, payment_info: Optional[Dict] = None):
-    """Update subscription details and optionally add to payment history."""
+    """Update subscription details and optionally add to payment history.
+
+    A single upsert covers both the existing-user and missing-user cases,
+    so every payment costs one DB round-trip instead of SELECT + UPDATE.
+    """
     if not conn: await init_db_pool()
 
-    user = await get_user(user_id)
-    if not user:
-        # Should not happen if user exists, but handle defensively
-        user_data = {
-            'subscription_active': is_active,
-            'subscription_end_date': end_date,
-            'auto_renewal': auto_renewal,
-            'payment_history': [payment_info] if payment_info else []
-        }
-        await add_or_update_user(user_id, user_data)
-        return
+    history_json = json.dumps(payment_info) if payment_info else None
+    params = (
+        user_id, is_active, end_date, _to_epoch(end_date), auto_renewal,
+        history_json, history_json, history_json, history_json,
+    )
 
-    # Update fields
-    update_data = {
-        'subscription_active': is_active,
-        'subscription_end_date': end_date,
-        'auto_renewal': auto_renewal
-    }
+    async with pool.acquire_write() as wc:
+        async with wc.cursor() as cur:
+            try:
+                await cur.execute(SQL_UPDATE_SUBSCRIPTION, params)
+                await wc.commit()  # Commit changes
+                _evict_user_cache(user_id)
+                logging.info(f"Subscription updated for user {user_id} in SQLite.")
+            except Exception as e:
+                logging.error(f"Error updating subscription for user {user_id} in SQLite: {e}")
+                raise
 
-    # Append to payment history if provided
-    current_history = user.get('payment_history', [])
-    if not isinstance(current_history, list): # Handle potential decoding issues
-         current_history = []
-    if payment_info:
-        current_history.append(payment_info)
-    update_data['payment_history'] = json.dumps(current_history) # Serialize back to JSON
+SQL_FINALIZE_PAYMENT = """
+    INSERT INTO users (user_id, subscription_active, subscription_end_date, subscription_end_ts, auto_renewal, user_data, payment_history)
+    VALUES (?, ?, ?, ?, ?, ?, CASE WHEN ? IS NULL THEN '[]' ELSE json_array(json(?)) END)
+    ON CONFLICT(user_id) DO UPDATE SET
+        subscription_active = excluded.subscription_active,
+        subscription_end_date = excluded.subscription_end_date,
+        subscription_end_ts = excluded.subscription_end_ts,
+        auto_renewal = excluded.auto_renewal,
+        user_data = excluded.user_data,
+        payment_history = CASE WHEN ? IS NULL THEN users.payment_history
+            ELSE json_insert(COALESCE(users.payment_history, '[]'), '$[#]', json(?)) END,
+        updated_at = CURRENT_TIMESTAMP;
+"""
 
-    fields = ', '.join([f"{key} = ?" for key in update_data.keys()]) # SQLite uses ? placeholders
-    values = list(update_data.values())
+async def finalize_payment(user_id: int, is_active: bool, end_date: Optional[datetime.datetime],
+                           auto_renewal: bool, payment_info: Optional[Dict] = None,
+                           user_data: Optional[str] = None):
+    """Apply a completed payment in a single upsert.
 
-    sql = f"UPDATE users SET {fields}, updated_at = CURRENT_TIMESTAMP WHERE user_id = ?" # SQLite uses ? placeholders
+    Fuses what used to be update_user_subscription followed by
+    add_or_update_user into one statement, so each payment costs one
+    BEGIN/COMMIT and one round-trip instead of two. `user_data` arrives
+    pre-serialized since the caller already has the JSON string.
+    """
+    if not conn: await init_db_pool()
 
-    async with conn.cursor() as cur:
-        try:
-            await cur.execute(sql, values + [user_id]) # Append user_id at the end
-            await conn.commit()  # Commit changes
-            logging.info(f"Subscription updated for user {user_id} in SQLite.")
-        except Exception as e:
-            logging.error(f"Error updating subscription for user {user_id} in SQLite: {e}")
-            raise
+    history_json = json.dumps(payment_info) if payment_info else None
+    params = (
+        user_id, is_active, end_date, _to_epoch(end_date), auto_renewal, user_data,
+        history_json, history_json, history_json, history_json,
+    )
+
+    async with pool.acquire_write() as wc:
+        async with wc.cursor() as cur:
+            try:
+                await cur.execute(SQL_FINALIZE_PAYMENT, params)
+                await wc.commit()  # Commit changes
+                _evict_user_cache(user_id)
+                logging.info(f"Payment finalized for user {user_id} in SQLite.")
+            except Exception as e:
+                logging.error(f"Error finalizing payment for user {user_id} in SQLite: {e}")
+                raise
+
+# The left_group <> ? guard makes repeated calls no-ops: SQLite touches no
+# pages and flushes nothing when the flag already has the requested value
+SQL_SET_LEFT_GROUP = "UPDATE users SET left_group = ?, updated_at = CURRENT_TIMESTAMP WHERE user_id = ? AND left_group <> ?"
 
 async def set_user_left_group(user_id: int, left: bool):
-    """Mark a user as having left the group."""
+    """Mark a user as having left the group (idempotent)."""
     if not conn: await init_db_pool()
-    sql = "UPDATE users SET left_group = ?, updated_at = CURRENT_TIMESTAMP WHERE user_id = ?" # SQLite uses ? placeholders
-    async with conn.cursor() as cur:
+    async with pool.acquire_write() as wc:
+        async with wc.cursor() as cur:
+            try:
+                await cur.execute(SQL_SET_LEFT_GROUP, (left, user_id, left))
+                await wc.commit()  # Commit changes
+                _evict_user_cache(user_id)
+                if cur.rowcount == 0:
+                    logging.debug(f"left_group={left} already set for user {user_id}, no-op.")
+                else:
+                    logging.info(f"Set left_group={left} for user {user_id} in SQLite.")
+            except Exception as e:
+                logging.error(f"Error setting left_group for user {user_id}: {e}")
+                raise
+
+async def set_users_left_group(user_ids: List[int], left: bool):
+    """Mark multiple users as having left the group in a single statement."""
+    if not user_ids:
+        return
+    if not conn: await init_db_pool()
+    placeholders = ', '.join(['?'] * len(user_ids))
+    sql = f"UPDATE users SET left_group = ?, updated_at = CURRENT_TIMESTAMP WHERE user_id IN ({placeholders}) AND left_group <> ?"
+    async with pool.acquire_write() as wc:
+        async with wc.cursor() as cur:
+            try:
+                await cur.execute(sql, [left] + list(user_ids) + [left])
+                await wc.commit()  # Commit changes
+                for uid in user_ids:
+                    _evict_user_cache(uid)
+                logging.info(f"Set left_group={left} for {len(user_ids)} users in SQLite.")
+            except Exception as e:
+                logging.error(f"Error setting left_group for users {user_ids}: {e}")
+                raise
+
+SQL_BULK_SET_LEFT_GROUP = "UPDATE users SET left_group = ?, updated_at = CURRENT_TIMESTAMP WHERE user_id = ?"
+
+async def bulk_set_left_group(items: List[Tuple[bool, int]]):
+    """Apply many (left, user_id) updates in one transaction.
+
+    executemany with a single commit collapses the O(N) per-row fsyncs of
+    calling set_user_left_group in a loop into one journal flush.
+    """
+    if not items:
+        return
+    if not conn: await init_db_pool()
+    async with pool.acquire_write() as wc:
         try:
-            await cur.execute(sql, (left, user_id))
-            await conn.commit()  # Commit changes
-            logging.info(f"Set left_group={left} for user {user_id} in SQLite.")
+            await wc.executemany(SQL_BULK_SET_LEFT_GROUP, items)
+            await wc.commit()  # Single commit for the whole batch
+            for _, uid in items:
+                _evict_user_cache(uid)
+            logging.info(f"Applied left_group updates for {len(items)} users in SQLite.")
         except Exception as e:
-            logging.error(f"Error setting left_group for user {user_id}: {e}")
+            logging.error(f"Error bulk-updating left_group: {e}")
             raise
 
 async def get_users_for_reminder(days_before_expiry: List[int]) -> List[Dict[str, Any]]:
     """Get users whose subscription expires in specified number of days."""
     if not conn: await init_db_pool()
 
-    # Create date conditions for each day offset
+    # Create half-open [day, day+1) range conditions for each day offset;
+    # unlike DATE(col) = ..., plain comparisons can use the index on
+    # subscription_end_date. Bound values are passed as ? parameters so
+    # SQLite can reuse one cached plan per number of day offsets. A CASE
+    # over the same ranges tags each row with its matched day offset, so
+    # one call with [7, 3, 1] replaces three separate round-trips.
     date_conditions = []
+    case_parts = []
+    where_params: List[Any] = []
+    case_params: List[Any] = []
     today = datetime.date.today()
     for days in days_before_expiry:
-        target_date = today + datetime.timedelta(days=days)
-        # Check for expiry on the target date (ignoring time part for the check)
-        date_conditions.append(f"DATE(subscription_end_date) = '{target_date.strftime('%Y-%m-%d')}'")
+        start = (today + datetime.timedelta(days=days)).isoformat()
+        end = (today + datetime.timedelta(days=days + 1)).isoformat()
+        date_conditions.append("(subscription_end_date >= ? AND subscription_end_date < ?)")
+        where_params.extend([start, end])
+        case_parts.append("WHEN subscription_end_date >= ? AND subscription_end_date < ? THEN ?")
+        case_params.extend([start, end, days])
 
     if not date_conditions:
         return []
 
     sql = f"""
-        SELECT user_id, subscription_end_date, left_group
+        SELECT user_id, subscription_end_date, left_group,
+               CASE {' '.join(case_parts)} END AS days_left
         FROM users
         WHERE subscription_active = TRUE
         AND subscription_end_date IS NOT NULL
         AND ({' OR '.join(date_conditions)});
     """
+    params = case_params + where_params
 
-    async with conn.cursor() as cur:
-        try:
-            await cur.execute(sql)
-            users = await cur.fetchall()
-            return users if users else []
-        except Exception as e:
-            logging.error(f"Error fetching users for reminder from SQLite: {e}")
-            return [] # Return empty list on error
+    async with pool.acquire_read() as rc:
+        async with rc.cursor() as cur:
+            try:
+                await cur.execute(sql, params)
+                users = await cur.fetchall()
+                return [dict(u) for u in users] if users else []
+            except Exception as e:
+                logging.error(f"Error fetching users for reminder from SQLite: {e}")
+                return [] # Return empty list on error
+
+# Prefer the epoch column (integer comparison); fall back to parsing the
+# legacy datetime column for rows written before the migration
+SQL_GET_EXPIRED_USERS = """
+    SELECT user_id
+    FROM users
+    WHERE subscription_active = FALSE
+    AND left_group = FALSE -- Only consider those not already marked as left
+    AND COALESCE(subscription_end_ts, CAST(strftime('%s', subscription_end_date) AS INTEGER)) < ?;
+"""
 
 async def get_expired_users_to_kick(days_threshold: int) -> List[int]:
     """Get users whose subscription expired more than 'days_threshold' ago and haven't renewed."""
     if not conn: await init_db_pool()
 
-    threshold_date = datetime.datetime.now() - datetime.timedelta(days=days_threshold)
+    threshold_ts = int(datetime.datetime.now().timestamp()) - days_threshold * 86400
 
-    sql = """
-        SELECT user_id
-        FROM users
-        WHERE subscription_active = FALSE
-        AND left_group = FALSE -- Only consider those not already marked as left
-        AND subscription_end_date IS NOT NULL
-        AND subscription_end_date < ?; -- SQLite uses ? placeholders
+    async with pool.acquire_read() as rc:
+        async with rc.cursor() as cur:
+            try:
+                await cur.execute(SQL_GET_EXPIRED_USERS, (threshold_ts,))
+                rows = await cur.fetchall()
+                return [row[0] for row in rows] if rows else []
+            except Exception as e:
+                logging.error(f"Error fetching expired users from SQLite: {e}")
+                return [] # Return empty list on error
+# Set-based deactivation: one UPDATE flips the flags and clears the tariff
+# state server-side (json_set), with RETURNING handing back the touched IDs
+# so the caller can notify - no per-user statements, no per-user commits
+SQL_BULK_DEACTIVATE_EXPIRED = """
+    UPDATE users
+    SET subscription_active = 0,
+        auto_renewal = 0,
+        user_data = json_set(COALESCE(user_data, '{}'), '$.current_tariff', NULL, '$.payment_method_id', NULL),
+        updated_at = CURRENT_TIMESTAMP
+    WHERE subscription_active = 1
+    AND COALESCE(subscription_end_ts, CAST(strftime('%s', subscription_end_date) AS INTEGER)) < ?
+    RETURNING user_id;
+"""
+
+async def bulk_deactivate_expired(days_past: int = 2) -> List[int]:
+    """Deactivate every subscription that expired more than 'days_past' days ago.
+
+    Returns the affected user IDs.
     """
+    if not conn: await init_db_pool()
+
+    threshold_ts = int(datetime.datetime.now().timestamp()) - days_past * 86400
+
+    async with pool.acquire_write() as wc:
+        async with wc.cursor() as cur:
+            try:
+                await cur.execute(SQL_BULK_DEACTIVATE_EXPIRED, (threshold_ts,))
+                rows = await cur.fetchall()
+                await wc.commit()  # Single commit for the whole sweep
+                user_ids = [row[0] for row in rows] if rows else []
+                for uid in user_ids:
+                    _evict_user_cache(uid)
+                if user_ids:
+                    logging.info(f"Deactivated {len(user_ids)} expired subscriptions in SQLite.")
+                return user_ids
+            except Exception as e:
+                logging.error(f"Error bulk-deactivating expired subscriptions: {e}")
+                return [] # Return empty list on error
+
+SQL_GET_AUTO_RENEWAL_DUE = """
+    SELECT user_id, user_data
+    FROM users
+    WHERE subscription_active = TRUE
+    AND auto_renewal = TRUE
+    AND COALESCE(subscription_end_ts, CAST(strftime('%s', subscription_end_date) AS INTEGER)) < ?;
+"""
+
+async def get_users_for_auto_renewal() -> List[Dict[str, Any]]:
+    """Get auto-renewal users whose subscription window has ended."""
+    if not conn: await init_db_pool()
+
+    now_ts = int(datetime.datetime.now().timestamp())
+
+    async with pool.acquire_read() as rc:
+        async with rc.cursor() as cur:
+            try:
+                await cur.execute(SQL_GET_AUTO_RENEWAL_DUE, (now_ts,))
+                rows = await cur.fetchall()
+                return [dict(r) for r in rows] if rows else []
+            except Exception as e:
+                logging.error(f"Error fetching auto-renewal users from SQLite: {e}")
+                return [] # Return empty list on error
 
-    async with conn.cursor() as cur:
-        try:
-            await cur.execute(sql, (threshold_date,)) # Pass threshold_date as parameter
-            users = await cur.fetchall()
-            return [user['user_id'] for user in users] if users else []
-        except Exception as e:
-            logging.error(f"Error fetching expired users from SQLite: {e}")
-            return [] # Return empty list on error
 # Example of how to use the pool in bot.py startup/shutdown
 # async def on_startup(dp):
 #     await init_db_pool()
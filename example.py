@@ -0,0 +1,58 @@
+"""Usage examples for the payment provider API.
+
+Run directly to exercise the demo provider without a Telegram bot:
+
+    python example.py
+"""
+
+import asyncio
+
+from payment_providers import DemoPaymentProvider
+
+
+async def create_simple_payment_example():
+    """Create a one-time payment through the demo provider."""
+    provider = DemoPaymentProvider(bot_username='example_bot')
+
+    result = await provider.create_payment(
+        user_id=12345,
+        amount=9.99,
+        currency='USD',
+        description='Monthly Subscription'
+    )
+
+    print(f"Payment created: {result.payment_id}")
+    print(f"Payment URL: {result.payment_url}")
+
+
+async def create_advanced_payment_example():
+    """Create a payment for a cart of products.
+
+    Prices are kept as integer kopecks end to end - float arithmetic on
+    monetary values drifts by a kopeck and breaks signed payloads.
+    """
+    provider = DemoPaymentProvider(bot_username='example_bot')
+
+    # price is in kopecks (minor units), quantity is a plain count
+    products = [
+        {'name': 'Group access, 1 month', 'price': 99900, 'quantity': 1},
+        {'name': 'Priority support', 'price': 49900, 'quantity': 2},
+    ]
+
+    total_kopecks = sum(int(item['price']) * int(item['quantity']) for item in products)
+
+    result = await provider.create_payment(
+        user_id=12345,
+        amount=total_kopecks / 100,  # Convert to major units only at the API boundary
+        currency='RUB',
+        description=', '.join(item['name'] for item in products),
+        metadata={'products': products}
+    )
+
+    print(f"Cart total: {total_kopecks} kopecks")
+    print(f"Payment created: {result.payment_id}")
+
+
+if __name__ == '__main__':
+    asyncio.run(create_simple_payment_example())
+    asyncio.run(create_advanced_payment_example())
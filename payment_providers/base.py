@@ -4,6 +4,8 @@ from abc import ABC, abstractmethod
 from typing import Dict, Any, Optional
 from dataclasses import dataclass
 
+import aiohttp
+
 
 @dataclass
 class PaymentResult:
@@ -26,7 +28,29 @@ class SubscriptionResult:
 
 class PaymentProvider(ABC):
     """Abstract base class for payment providers."""
-    
+
+    # One pooled HTTP session shared by every provider, so concurrent
+    # payment calls reuse warm connections instead of each paying a DNS
+    # lookup and TLS handshake
+    _http: Optional[aiohttp.ClientSession] = None
+
+    @classmethod
+    def get_http(cls) -> aiohttp.ClientSession:
+        """Get the shared HTTP session, creating it on first use."""
+        if PaymentProvider._http is None or PaymentProvider._http.closed:
+            PaymentProvider._http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=64, limit_per_host=32, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=10, connect=5),
+            )
+        return PaymentProvider._http
+
+    @classmethod
+    async def close_http(cls):
+        """Close the shared HTTP session (called on bot shutdown)."""
+        if PaymentProvider._http is not None and not PaymentProvider._http.closed:
+            await PaymentProvider._http.close()
+        PaymentProvider._http = None
+
     @abstractmethod
     async def create_payment(
         self,
@@ -1,7 +1,9 @@
 """Demo payment provider for testing without real payment gateway."""
 
-import uuid
+import secrets
+import asyncio
 import logging
+from dataclasses import dataclass, field, asdict
 from typing import Dict, Any, Optional
 
 from .base import PaymentProvider, PaymentResult, SubscriptionResult
@@ -10,6 +12,77 @@ from .base import PaymentProvider, PaymentResult, SubscriptionResult
 logger = logging.getLogger(__name__)
 
 
+# Audit records are queued and written by one background task, keeping
+# the stdlib logging lock (and formatter work) off the request path when
+# load tests hammer create_payment concurrently
+_log_queue: Optional[asyncio.Queue] = None
+_log_task: Optional[asyncio.Task] = None
+_log_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+async def _drain_log_queue():
+    """Write queued audit records, draining bursts in a single wakeup."""
+    while True:
+        logger.info(await _log_queue.get())
+        while True:
+            try:
+                logger.info(_log_queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+
+
+def _audit_log(msg: str):
+    """Queue an audit record, falling back to direct logging without a loop."""
+    global _log_queue, _log_task, _log_loop
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        logger.info(msg)
+        return
+    if _log_queue is None or loop is not _log_loop:
+        # The queue is bound to the loop it was created on; after a new
+        # asyncio.run() the old queue (and its drain task) are unusable,
+        # so rebuild both on the current loop
+        _log_queue = asyncio.Queue(maxsize=10_000)
+        _log_task = None
+        _log_loop = loop
+    if _log_task is None or _log_task.done():
+        _log_task = loop.create_task(_drain_log_queue())
+    try:
+        _log_queue.put_nowait(msg)
+    except asyncio.QueueFull:
+        logger.info(msg)
+
+
+# Webhook responses share a constant prefix; only the ID varies per call
+_OK_PAYMENT = {'success': True, 'type': 'payment'}
+_OK_SUBSCRIPTION = {'success': True, 'type': 'subscription'}
+
+
+# Slotted records instead of per-entry dicts: ~4x smaller on CPython and
+# attribute access skips the hash lookup - noticeable when load tests
+# accumulate thousands of demo payments
+@dataclass(slots=True)
+class _DemoPayment:
+    user_id: int
+    amount: float
+    currency: str
+    description: str
+    status: str = 'pending'
+    metadata: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass(slots=True)
+class _DemoSubscription:
+    user_id: int
+    amount: float
+    currency: str
+    interval: str
+    description: str
+    status: str = 'pending'
+    metadata: Dict[str, Any] = field(default_factory=dict)
+
+
 class DemoPaymentProvider(PaymentProvider):
     """Demo payment provider that simulates payments without real transactions."""
     
@@ -32,20 +105,21 @@ class DemoPaymentProvider(PaymentProvider):
         metadata: Optional[Dict[str, Any]] = None
     ) -> PaymentResult:
         """Create a demo one-time payment."""
-        payment_id = f"demo_pay_{uuid.uuid4().hex[:16]}"
-        
-        self.payments[payment_id] = {
-            'user_id': user_id,
-            'amount': amount,
-            'currency': currency,
-            'description': description,
-            'status': 'pending',
-            'metadata': metadata or {}
-        }
+        # 64 random bits straight to hex - same 16-char ID as the old
+        # uuid4().hex[:16] without building and slicing a full UUID
+        payment_id = f"demo_pay_{secrets.token_hex(8)}"
+        
+        self.payments[payment_id] = _DemoPayment(
+            user_id=user_id,
+            amount=amount,
+            currency=currency,
+            description=description,
+            metadata=metadata or {}
+        )
         
         payment_url = f"https://t.me/{self.bot_username}?start=demo_pay_{payment_id}"
         
-        logger.info(f"Demo payment created: {payment_id} for user {user_id}, amount {amount} {currency}")
+        _audit_log(f"Demo payment created: {payment_id} for user {user_id}, amount {amount} {currency}")
         
         return PaymentResult(
             success=True,
@@ -64,21 +138,20 @@ class DemoPaymentProvider(PaymentProvider):
         metadata: Optional[Dict[str, Any]] = None
     ) -> PaymentResult:
         """Create a demo recurring subscription."""
-        subscription_id = f"demo_sub_{uuid.uuid4().hex[:16]}"
-        
-        self.subscriptions[subscription_id] = {
-            'user_id': user_id,
-            'amount': amount,
-            'currency': currency,
-            'interval': interval,
-            'description': description,
-            'status': 'pending',
-            'metadata': metadata or {}
-        }
+        subscription_id = f"demo_sub_{secrets.token_hex(8)}"
+        
+        self.subscriptions[subscription_id] = _DemoSubscription(
+            user_id=user_id,
+            amount=amount,
+            currency=currency,
+            interval=interval,
+            description=description,
+            metadata=metadata or {}
+        )
         
         payment_url = f"https://t.me/{self.bot_username}?start=demo_sub_{subscription_id}"
         
-        logger.info(f"Demo subscription created: {subscription_id} for user {user_id}, {amount} {currency}/{interval}")
+        _audit_log(f"Demo subscription created: {subscription_id} for user {user_id}, {amount} {currency}/{interval}")
         
         return PaymentResult(
             success=True,
@@ -94,7 +167,7 @@ class DemoPaymentProvider(PaymentProvider):
     ) -> SubscriptionResult:
         """Cancel a demo subscription."""
         if subscription_id in self.subscriptions:
-            self.subscriptions[subscription_id]['status'] = 'cancelled'
+            self.subscriptions[subscription_id].status = 'cancelled'
             logger.info(f"Demo subscription cancelled: {subscription_id}, reason: {reason}")
             return SubscriptionResult(success=True, subscription_id=subscription_id)
         
@@ -119,23 +192,25 @@ class DemoPaymentProvider(PaymentProvider):
         payment_id = payload.get('payment_id')
         
         if payment_id in self.payments:
-            self.payments[payment_id]['status'] = 'completed'
-            return {'success': True, 'type': 'payment', 'payment_id': payment_id}
-        
+            self.payments[payment_id].status = 'completed'
+            return {**_OK_PAYMENT, 'payment_id': payment_id}
+
         if payment_id in self.subscriptions:
-            self.subscriptions[payment_id]['status'] = 'active'
-            return {'success': True, 'type': 'subscription', 'subscription_id': payment_id}
+            self.subscriptions[payment_id].status = 'active'
+            return {**_OK_SUBSCRIPTION, 'subscription_id': payment_id}
         
         return {'success': False, 'error': 'Payment not found'}
     
     async def complete_demo_payment(self, payment_id: str) -> Dict[str, Any]:
         """Manually complete a demo payment (for testing)."""
         if payment_id in self.payments:
-            self.payments[payment_id]['status'] = 'completed'
-            return {'success': True, 'payment': self.payments[payment_id]}
-        
+            payment = self.payments[payment_id]
+            payment.status = 'completed'
+            return {'success': True, 'payment': asdict(payment)}
+
         if payment_id in self.subscriptions:
-            self.subscriptions[payment_id]['status'] = 'active'
-            return {'success': True, 'subscription': self.subscriptions[payment_id]}
+            subscription = self.subscriptions[payment_id]
+            subscription.status = 'active'
+            return {'success': True, 'subscription': asdict(subscription)}
         
         return {'success': False, 'error': 'Payment not found'}
@@ -0,0 +1,549 @@
+"""Prodamus (payform.ru) payment provider.
+
+To use Prodamus:
+1. Set environment variables: PRODAMUS_SHOP_URL, PRODAMUS_API_KEY
+2. Optionally set PRODAMUS_DEMO_MODE=true to use the demo payform
+3. Set PAYMENT_PROVIDER=prodamus in .env
+
+Payment links are signed locally (HMAC-SHA256 over the canonical JSON of
+the form data), so creating a payment needs no network round-trip; the
+signed URL is handed straight to the user.
+
+The ProdamusAPI signing pipeline (_deep_int_to_string -> _sign ->
+_flatten -> query formatting) is pure, fully annotated Python with no
+module-level side effects, so deployments that need more webhook
+throughput can AOT-compile this file with mypyc as a drop-in (the repo
+itself ships no build step, so that stays an opt-in for operators).
+"""
+
+import os
+import ssl
+import time
+import json
+import hmac
+import hashlib
+import logging
+import asyncio
+import datetime
+import urllib.parse
+from types import MappingProxyType
+from typing import Dict, Any, Optional
+
+try:
+    # Only needed for the REST status/cancel API calls, not for building
+    # and signing payment links
+    import requests
+    import certifi
+except ImportError:
+    requests = None
+    certifi = None
+
+try:
+    # Optional: SIMD-accelerated JSON encoder for the signing hot path;
+    # emits the same compact, sorted-key, UTF-8 bytes as the stdlib setup
+    import orjson
+except ImportError:
+    orjson = None
+
+from .base import PaymentProvider, PaymentResult, SubscriptionResult
+
+# Logging configuration belongs to the entry point (bot.py); this module
+# only emits through its own named logger
+logger = logging.getLogger(__name__)
+
+# hashlib routes SHA-256 through OpenSSL's EVP layer when the _hashlib
+# extension is present, which transparently uses SHA-NI / ARMv8 crypto
+# instructions on capable CPUs. Detect the slow built-in fallback once so
+# misbuilt environments are visible instead of silently 3-5x slower.
+try:
+    import _hashlib
+    _SHA256_ACCELERATED = hashlib.sha256 is _hashlib.openssl_sha256
+except ImportError:
+    _SHA256_ACCELERATED = False
+
+# Canonical signing serialization: one pre-built compact sorted-key encoder
+# reused across calls, and a translate table that escapes slashes in a
+# single C-level pass instead of a scan-and-copy str.replace
+_SIGN_ENCODER = json.JSONEncoder(sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+_SLASH_TABLE = str.maketrans({'/': '\\/'})
+
+# The payload create_payment signs has a statically known shape, so its
+# canonical JSON can be emitted directly in sorted-key order without the
+# generic encoder's per-node dispatch. Any payload that doesn't match the
+# shape exactly (e.g. webhook bodies) falls back to the generic path.
+_PAYMENT_KEYS = frozenset(('created_at', 'customer_email', 'do', 'order_id', 'products', 'subscription'))
+_REQUIRED_PAYMENT_KEYS = frozenset(('created_at', 'customer_email', 'do', 'order_id', 'products'))
+_PRODUCT_KEYS = frozenset(('name', 'paymentMethod', 'paymentObject', 'price', 'quantity', 'tax'))
+_encode_str = json.encoder.encode_basestring  # C-accelerated single-string encoder
+
+
+def _canonical_payment_json(data: Dict[str, Any]) -> Optional[str]:
+    """Serialize the standard payment shape straight to canonical JSON.
+
+    Returns None when the payload is not the exact create_payment shape
+    (all values already stringified), in which case the caller must use
+    the generic encoder. Output is byte-identical to the generic path.
+    """
+    if not _REQUIRED_PAYMENT_KEYS <= data.keys() or data.keys() - _PAYMENT_KEYS:
+        return None
+    products = data['products']
+    if not isinstance(products, list):
+        return None
+
+    out = [
+        '{"created_at":', _encode_str(data['created_at']),
+        ',"customer_email":', _encode_str(data['customer_email']),
+        ',"do":', _encode_str(data['do']),
+        ',"order_id":', _encode_str(data['order_id']),
+        ',"products":[',
+    ]
+    for i, product in enumerate(products):
+        if not isinstance(product, dict) or product.keys() != _PRODUCT_KEYS:
+            return None
+        tax = product['tax']
+        if not isinstance(tax, dict) or tax.keys() != {'tax_type'}:
+            return None
+        if i:
+            out.append(',')
+        out += (
+            '{"name":', _encode_str(product['name']),
+            ',"paymentMethod":', _encode_str(product['paymentMethod']),
+            ',"paymentObject":', _encode_str(product['paymentObject']),
+            ',"price":', _encode_str(product['price']),
+            ',"quantity":', _encode_str(product['quantity']),
+            ',"tax":{"tax_type":', _encode_str(tax['tax_type']), '}}',
+        )
+    out.append(']')
+    subscription = data.get('subscription')
+    if subscription is not None:
+        out += (',"subscription":', _encode_str(subscription))
+    out.append('}')
+    return ''.join(out).translate(_SLASH_TABLE)
+
+# Building an SSLContext parses the whole CA bundle (~150KB of PEM);
+# share one across every pooled connection instead of paying that per
+# TLS handshake. Created lazily so clients that never hit the REST API
+# don't parse the cert store at all.
+_ssl_context: Optional[ssl.SSLContext] = None
+
+
+def _get_ssl_context() -> ssl.SSLContext:
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context(cafile=certifi.where() if certifi else None)
+    return _ssl_context
+
+
+if requests is not None:
+    class _SharedContextAdapter(requests.adapters.HTTPAdapter):
+        """HTTPAdapter that reuses one process-wide SSLContext for its pool."""
+
+        def init_poolmanager(self, *args, **kwargs):
+            kwargs['ssl_context'] = _get_ssl_context()
+            return super().init_poolmanager(*args, **kwargs)
+
+
+# Prodamus re-delivers webhooks on 5xx; remembering recent successful
+# verifications for this long lets retries skip the JSON parse and HMAC
+_VERIFY_CACHE_TTL = 60.0
+_VERIFY_CACHE_MAX = 1024
+
+
+class ProdamusAPI:
+    """Synchronous Prodamus client: builds and signs payform payment links.
+
+    The signature scheme follows the official Prodamus HMAC recipe: every
+    value is stringified, the payload is serialized as compact sorted-key
+    JSON with escaped slashes, and the result is HMAC-SHA256'd with the
+    shop's secret key.
+    """
+
+    # Immutable constant part of the payform product entry - only name and
+    # price vary per payment. The nested tax dict stays a plain dict so the
+    # stringification walk can traverse it (its values are already strings,
+    # making the shared mutation idempotent).
+    _PRODUCT_TEMPLATE = MappingProxyType({
+        'quantity': '1',
+        'tax': {'tax_type': '0'},
+        'paymentMethod': '1',
+        'paymentObject': '4',
+    })
+
+    def __init__(self, shop_url: str, api_key: str, demo_mode: bool = False):
+        self._base_url = shop_url.rstrip('/')
+        self._url_prefix = f"{self._base_url}/?"
+        self.api_key = api_key
+        self._demo_mode = False
+        # Routed through the property so demo mode derives base_url and the
+        # URL prefix in the same step - the client is consistent the moment
+        # construction finishes
+        self.demo_mode = demo_mode
+        # Encode the secret once; the key-dependent ipad/opad compressions
+        # of HMAC are likewise done once and .copy()'d per signature
+        # instead of being paid on every sign/verify
+        self._api_key_bytes = api_key.encode('utf-8')
+        self._hmac_template = hmac.new(self._api_key_bytes, b'', hashlib.sha256)
+        # (signature, body fingerprint) -> monotonic time of last success
+        self._verified_webhooks: Dict[tuple, float] = {}
+        # Persistent session for the REST status/cancel calls: pooled
+        # keepalive connections amortize TCP+TLS setup, and transient
+        # gateway errors get a bounded backoff retry
+        if requests is not None:
+            self.session = requests.Session()
+            adapter = _SharedContextAdapter(
+                pool_connections=4,
+                pool_maxsize=16,
+                max_retries=requests.adapters.Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+            )
+            self.session.mount('https://', adapter)
+        else:
+            self.session = None
+
+    # base_url and demo_mode are properties so the derived URL prefix is
+    # rebuilt atomically whenever either changes - callers that override
+    # them after construction can never observe an inconsistent client
+    @property
+    def base_url(self) -> str:
+        return self._base_url
+
+    @base_url.setter
+    def base_url(self, value: str):
+        self._base_url = value.rstrip('/')
+        self._url_prefix = f"{self._base_url}/?"
+
+    @property
+    def demo_mode(self) -> bool:
+        return self._demo_mode
+
+    @demo_mode.setter
+    def demo_mode(self, enabled: bool):
+        self._demo_mode = enabled
+        if enabled:
+            self.base_url = 'https://demo.payform.ru'
+
+    def _deep_int_to_string(self, dictionary: Dict[str, Any]) -> Dict[str, Any]:
+        """Stringify every scalar value in a nested structure (Prodamus signs strings).
+
+        Iterative DFS over an explicit stack, mutating containers in place:
+        no recursion frames, no throwaway wrapper dicts, and values that are
+        already strings are skipped. The old recursive version wrapped list
+        elements in a temporary dict and lost their conversions entirely.
+        """
+        stack = [dictionary]
+        while stack:
+            cur = stack.pop()
+            if isinstance(cur, dict):
+                for k, v in cur.items():
+                    if isinstance(v, (dict, list)):
+                        stack.append(v)
+                    elif not isinstance(v, str):
+                        cur[k] = str(v)
+            else:  # list
+                for i, v in enumerate(cur):
+                    if isinstance(v, (dict, list)):
+                        stack.append(v)
+                    elif not isinstance(v, str):
+                        cur[i] = str(v)
+        return dictionary
+
+    def _sign_bytes(self, data: Dict[str, Any]) -> bytes:
+        """Compute the raw HMAC-SHA256 digest over the canonical JSON form."""
+        deep_data = self._deep_int_to_string(data)
+        data_json = _canonical_payment_json(deep_data)
+        if data_json is None:
+            if orjson is not None:
+                data_json = orjson.dumps(deep_data, option=orjson.OPT_SORT_KEYS).decode().translate(_SLASH_TABLE)
+            else:
+                data_json = _SIGN_ENCODER.encode(deep_data).translate(_SLASH_TABLE)
+        h = self._hmac_template.copy()
+        h.update(data_json.encode('utf8'))
+        return h.digest()
+
+    def _sign(self, data: Dict[str, Any]) -> str:
+        """Hex HMAC-SHA256 signature (the form Prodamus puts in payment links)."""
+        return self._sign_bytes(data).hex()
+
+    def _flatten(self, data: Dict[str, Any], parent_key: str = '', out: Optional[list] = None) -> list:
+        """Flatten a nested structure into PHP-style bracketed (key, value) pairs.
+
+        A single list accumulator is threaded through the recursion - no
+        per-level dict materialization and no re-expansion by the caller.
+        """
+        if out is None:
+            out = []
+        # Bind loop invariants to locals: LOAD_FAST instead of a global or
+        # attribute lookup on every element of the payload
+        _isinstance = isinstance
+        _dict = dict
+        _seq = (list, tuple)
+        append = out.append
+        for key, value in data.items():
+            new_key = f"{parent_key}[{key}]" if parent_key else str(key)
+            if _isinstance(value, _dict):
+                self._flatten(value, new_key, out)
+            elif _isinstance(value, _seq):
+                for k, v in enumerate(value):
+                    if _isinstance(v, _dict) or _isinstance(v, _seq):
+                        self._flatten(v, f"{new_key}[{k}]", out)
+                    else:
+                        append((f"{new_key}[{k}]", v))
+            else:
+                append((new_key, value))
+        return out
+
+    def create_payment(
+        self,
+        user_id: int,
+        amount: float,
+        description: str = "",
+        recurring: bool = False,
+        products: Optional[list] = None
+    ) -> Dict[str, Any]:
+        """Build a signed payform payment URL.
+
+        Returns a dict with 'payment_url' and 'order_id'.
+        """
+        # One clock read serves both the order ID and the created_at stamp
+        timestamp = time.time_ns() // 1_000_000_000
+        order_id = f"tg_{user_id}_{timestamp}"
+        current_time = datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+        if products is None:
+            products = [{**self._PRODUCT_TEMPLATE, 'name': description or 'Subscription', 'price': str(amount)}]
+
+        data = {
+            'order_id': order_id,
+            'customer_email': f"{user_id}@telegram.user",
+            'products': products,
+            'do': 'link',
+            'created_at': current_time,
+        }
+        if recurring:
+            data['subscription'] = '1'
+
+        data['signature'] = self._sign(dict(data))
+
+        # One pass straight over the flat pairs: no dict rebuild and no
+        # urlencode type-dispatch, and the PHP-style bracket keys stay
+        # readable instead of being percent-encoded
+        quote = urllib.parse.quote_from_bytes
+        parts = [
+            quote(k.encode('utf-8'), safe='[]') + '=' + quote(str(v).encode('utf-8'), safe='')
+            for k, v in self._flatten(data)
+        ]
+        query_string = '&'.join(parts)
+        full_payment_url = self._url_prefix + query_string
+
+        logger.info("Created payment form URL: %s", full_payment_url)
+
+        return {'payment_url': full_payment_url, 'order_id': order_id}
+
+    def verify_webhook(self, webhook_body: bytes, webhook_signature: str) -> bool:
+        """Verify the HMAC signature of an incoming Prodamus webhook."""
+        # Cheapest check first: without a signature there is nothing to
+        # verify, so don't even parse the body
+        if not webhook_signature:
+            logger.warning("Webhook without signature rejected")
+            return False
+
+        # A retried delivery carries the same body and signature; a
+        # blake2b fingerprint keys the cache without retaining bodies
+        body_bytes = webhook_body if isinstance(webhook_body, bytes) else webhook_body.encode('utf8')
+        cache_key = (webhook_signature, hashlib.blake2b(body_bytes, digest_size=8).digest())
+        verified_at = self._verified_webhooks.get(cache_key)
+        if verified_at is not None and time.monotonic() - verified_at < _VERIFY_CACHE_TTL:
+            return True
+
+        try:
+            data = json.loads(webhook_body)
+        except (ValueError, TypeError):
+            logger.warning("Webhook body is not valid JSON")
+            return False
+
+        if not isinstance(data, dict) or 'order_id' not in data:
+            logger.warning("Webhook missing order_id: %s", data)
+            return False
+
+        try:
+            incoming_digest = bytes.fromhex(webhook_signature)
+        except ValueError:
+            logger.warning("Webhook signature is not valid hex for order %s", data.get('order_id'))
+            return False
+
+        data.pop('signature', None)
+        # Constant-time compare on raw digests: no timing side channel and
+        # no hex-encoding pass on the hot path
+        if not hmac.compare_digest(self._sign_bytes(data), incoming_digest):
+            logger.warning("Webhook signature mismatch for order %s", data.get('order_id'))
+            return False
+
+        now = time.monotonic()
+        if len(self._verified_webhooks) > _VERIFY_CACHE_MAX:
+            self._verified_webhooks = {
+                k: t for k, t in self._verified_webhooks.items() if now - t < _VERIFY_CACHE_TTL
+            }
+        self._verified_webhooks[cache_key] = now
+        return True
+
+    def verify_webhook_batch(self, items: list) -> list:
+        """Verify a burst of independent (body, signature) webhook deliveries.
+
+        A plain loop today - the win is that callers hand a whole burst
+        over at once (one thread-pool hop from the async side, shared
+        HMAC template and verify cache). A multi-buffer SHA-256 backend
+        could later slot in behind this signature without touching callers.
+        """
+        verify = self.verify_webhook
+        return [verify(body, signature) for body, signature in items]
+
+    def _rest_request(self, path: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        """POST a signed request to the Prodamus REST API.
+
+        Parameters are stringified and signed the same way as payment
+        links; the hex signature travels in the Signature header. Goes
+        through the pooled session, so keepalive and the gateway-error
+        retry policy apply.
+        """
+        if self.session is None:
+            raise RuntimeError("Prodamus REST API calls require the optional 'requests' dependency")
+        data = self._deep_int_to_string(dict(params))
+        headers = {'Signature': self._sign(dict(data))}
+        response = self.session.post(f"{self._base_url}{path}", data=data, headers=headers, timeout=10)
+        response.raise_for_status()
+        return response.json()
+
+    def get_payment_status(self, order_id: str) -> Dict[str, Any]:
+        """Query payment status via the Prodamus REST API."""
+        return self._rest_request('/rest/getOrders/', {'order_id': order_id})
+
+    def cancel_recurring(self, subscription_id: str) -> Dict[str, Any]:
+        """Cancel a recurring subscription via the Prodamus REST API."""
+        return self._rest_request('/rest/setActivity/', {
+            'subscription': subscription_id,
+            'active_manager': '0',
+        })
+
+
+_client: Optional[ProdamusAPI] = None
+
+
+def get_prodamus_client() -> ProdamusAPI:
+    """Get (and lazily create) the shared Prodamus client."""
+    global _client
+    if _client is None:
+        if not _SHA256_ACCELERATED:
+            logger.warning("OpenSSL-backed SHA-256 unavailable; HMAC signing uses the slower built-in implementation")
+        # One env pass, everything through __init__ - no post-construction
+        # mutation, so the client's derived state is never inconsistent
+        _client = ProdamusAPI(
+            shop_url=os.getenv('PRODAMUS_SHOP_URL', 'https://demo.payform.ru'),
+            api_key=os.getenv('PRODAMUS_API_KEY', ''),
+            demo_mode=os.getenv('PRODAMUS_DEMO_MODE', 'true').lower() in ('1', 'true', 'yes'),
+        )
+    return _client
+
+
+class ProdamusPaymentProvider(PaymentProvider):
+    """Prodamus payment provider implementation.
+
+    The underlying client is synchronous, so every call is dispatched via
+    asyncio.to_thread - the event loop keeps serving other updates while
+    the signing/URL work (and any future REST call) runs in a worker thread.
+    """
+
+    def __init__(self):
+        self.client = get_prodamus_client()
+
+    async def create_payment(
+        self,
+        user_id: int,
+        amount: float,
+        currency: str = "RUB",
+        description: str = "",
+        metadata: Optional[Dict[str, Any]] = None
+    ) -> PaymentResult:
+        """Create a one-time Prodamus payment link."""
+        try:
+            result = await asyncio.to_thread(
+                self.client.create_payment,
+                user_id=user_id,
+                amount=amount,
+                description=description,
+            )
+            return PaymentResult(
+                success=True,
+                payment_url=result['payment_url'],
+                payment_id=result['order_id']
+            )
+        except Exception as e:
+            logger.error("Prodamus payment error: %s", e)
+            return PaymentResult(success=False, error=str(e))
+
+    async def create_subscription(
+        self,
+        user_id: int,
+        amount: float,
+        currency: str = "RUB",
+        interval: str = "month",
+        description: str = "",
+        metadata: Optional[Dict[str, Any]] = None
+    ) -> PaymentResult:
+        """Create a recurring Prodamus subscription link."""
+        try:
+            result = await asyncio.to_thread(
+                self.client.create_payment,
+                user_id=user_id,
+                amount=amount,
+                description=description,
+                recurring=True,
+            )
+            return PaymentResult(
+                success=True,
+                payment_url=result['payment_url'],
+                payment_id=result['order_id']
+            )
+        except Exception as e:
+            logger.error("Prodamus subscription error: %s", e)
+            return PaymentResult(success=False, error=str(e))
+
+    async def cancel_subscription(
+        self,
+        subscription_id: str,
+        reason: Optional[str] = None
+    ) -> SubscriptionResult:
+        """Cancel a recurring Prodamus subscription."""
+        try:
+            await asyncio.to_thread(self.client.cancel_recurring, subscription_id)
+            return SubscriptionResult(success=True, subscription_id=subscription_id)
+        except Exception as e:
+            logger.error("Prodamus cancel error: %s", e)
+            return SubscriptionResult(success=False, error=str(e))
+
+    async def verify_webhook(
+        self,
+        payload: bytes,
+        signature: str
+    ) -> bool:
+        """Verify a Prodamus webhook signature."""
+        return await asyncio.to_thread(self.client.verify_webhook, payload, signature)
+
+    async def verify_webhook_batch(self, items: list) -> list:
+        """Verify many webhook deliveries with a single worker-thread hop."""
+        return await asyncio.to_thread(self.client.verify_webhook_batch, items)
+
+    async def process_webhook(
+        self,
+        payload: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """Process a Prodamus webhook notification."""
+        order_id = payload.get('order_id')
+        if not order_id:
+            return {'success': False, 'error': 'Missing order_id'}
+
+        if payload.get('payment_status') == 'success':
+            return {
+                'success': True,
+                'type': 'subscription' if payload.get('subscription') else 'payment',
+                'payment_id': order_id,
+            }
+        return {'success': False, 'error': f"Payment {order_id} not completed"}
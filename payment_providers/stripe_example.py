@@ -39,9 +39,11 @@ class StripePaymentProvider(PaymentProvider):
         metadata: Optional[Dict[str, Any]] = None
     ) -> PaymentResult:
         """Create a Stripe payment session."""
-        # Example implementation:
+        # Example implementation (the stripe SDK is synchronous, so run it
+        # in a worker thread to keep the event loop free):
         # try:
-        #     session = stripe.checkout.Session.create(
+        #     session = await asyncio.to_thread(
+        #         stripe.checkout.Session.create,
         #         payment_method_types=['card'],
         #         line_items=[{
         #             'price_data': {
@@ -91,8 +93,9 @@ class StripePaymentProvider(PaymentProvider):
         #         product_data={'name': description}
         #     )
         #     
-        #     # Create checkout session
-        #     session = stripe.checkout.Session.create(
+        #     # Create checkout session (in a worker thread, like create_payment)
+        #     session = await asyncio.to_thread(
+        #         stripe.checkout.Session.create,
         #         customer=customer.id,
         #         payment_method_types=['card'],
         #         line_items=[{'price': price.id, 'quantity': 1}],
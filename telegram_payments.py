@@ -0,0 +1,521 @@
+"""Telegram-native payments (send_invoice) with YooKassa recurring charges.
+
+Covers the full subscription lifecycle: invoice creation, successful-payment
+processing, saved-payment-method lookup for auto-renewal, expiry reminders
+and deactivation sweeps. Requires a Telegram payments provider token; the
+optional ``yookassa`` SDK enables direct payments and recurring charges.
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import datetime
+import functools
+from enum import StrEnum
+from typing import Dict, List, Optional, Any
+
+from aiogram import Bot
+from aiogram.types import LabeledPrice
+
+try:
+    # Optional: much faster JSON encode/decode for hot paths
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # Optional: only needed for direct/recurring YooKassa charges
+    from yookassa import Configuration, Payment
+except ImportError:
+    Configuration = None
+    Payment = None
+
+import db
+
+
+logger = logging.getLogger(__name__)
+
+PROVIDER_TOKEN = os.getenv('TELEGRAM_PROVIDER_TOKEN', '')
+YOOKASSA_SHOP_ID = os.getenv('YOOKASSA_SHOP_ID', '')
+YOOKASSA_SECRET_KEY = os.getenv('YOOKASSA_SECRET_KEY', '')
+YOOKASSA_RETURN_URL = os.getenv('YOOKASSA_RETURN_URL', 'https://t.me/')
+
+CURRENCY = os.getenv('CURRENCY', 'RUB')
+
+if Configuration is not None and YOOKASSA_SHOP_ID:
+    Configuration.account_id = YOOKASSA_SHOP_ID
+    Configuration.secret_key = YOOKASSA_SECRET_KEY
+
+class Tariff(StrEnum):
+    """Known tariff identifiers.
+
+    StrEnum members hash and compare equal to their plain-string values,
+    so payload-derived strings still work for dict lookups while typed
+    callers get interpreter-specialized comparisons and typo safety.
+    """
+    BASIC = 'basic'
+    STANDARD = 'standard'
+    PREMIUM = 'premium'
+
+
+# Prices are in minor units (kopecks), as Telegram's LabeledPrice expects
+SUBSCRIPTION_TARIFFS = {
+    Tariff.BASIC: {'name': 'Basic', 'price': 19900, 'days': 30,
+                   'description': 'Access to the group'},
+    Tariff.STANDARD: {'name': 'Standard', 'price': 29900, 'days': 30,
+                      'description': 'Access to the group and weekly digests'},
+    Tariff.PREMIUM: {'name': 'Premium', 'price': 49900, 'days': 30,
+                     'description': 'Full access including personal support'},
+}
+
+# JSON helpers: orjson is C-accelerated and several times faster than the
+# stdlib on the payload/user_data blobs this module round-trips on every
+# payment. DB columns are TEXT, so decode back to str only at the storage
+# boundary; orjson.JSONDecodeError subclasses ValueError, so callers catch
+# ValueError and work with either backend.
+if orjson is not None:
+    def _dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+    _loads = orjson.loads
+else:
+    # Compact separators match orjson's output and shave ~10% off every
+    # stored user_data/payload blob. The columns stay JSON TEXT (not a
+    # binary format) because db.py manipulates them with SQLite's json_*
+    # operators server-side.
+    _dumps = functools.partial(json.dumps, separators=(',', ':'))
+    _loads = json.loads
+
+
+# Invoice building blocks are constant per tariff, so format them once at
+# import: titles, descriptions, LabeledPrice rows and the YooKassa decimal
+# amount string. Prices are stored as a tuple and copied to a list per
+# send, since aiogram wants a list it may mutate.
+_TARIFF_CACHE = {
+    tariff: {
+        'title': f"Subscription: {config['name']}",
+        'description': f"{config['description']} ({config['days']} days)",
+        'prices': (LabeledPrice(label=config['name'], amount=config['price']),),
+        'amount_value': f"{config['price'] / 100:.2f}",
+        'payment_description': f"Subscription: {config['name']} ({config['days']} days)",
+        'renewal_description': f"Subscription renewal: {config['name']}",
+    }
+    for tariff, config in SUBSCRIPTION_TARIFFS.items()
+}
+
+# Caps how many payment finalizations run concurrently, so a burst of
+# webhooks can't open unbounded YooKassa lookups and DB writes at once
+_finalize_semaphore = asyncio.Semaphore(8)
+
+# Strong references to in-flight finalizations - the event loop holds
+# tasks only weakly, so without these a queued finalization could be
+# garbage-collected before it runs and a paid update silently lost
+_finalize_tasks: set = set()
+
+
+def _idempotence_key(user_id: int, tariff: Tariff) -> str:
+    """Build a natural idempotency key for a YooKassa charge.
+
+    user + millisecond + tariff identifies the charge just as well as a
+    uuid4() (which costs a getrandom syscall per call), and doubles as a
+    guard: YooKassa rejects a duplicate renewal for the same user and
+    instant instead of charging twice.
+    """
+    return f"{user_id}-{time.time_ns() // 1_000_000}-{tariff}"
+
+
+def get_tariff_info(tariff: str) -> Optional[Dict[str, Any]]:
+    """Return a copy of the config dict for a tariff, or None if unknown.
+
+    A copy so callers can annotate it freely without poisoning the shared
+    tariff table; a three-entry dict lookup needs no caching on top.
+    """
+    info = SUBSCRIPTION_TARIFFS.get(tariff)
+    return dict(info) if info is not None else None
+
+
+# The token is fixed for the process lifetime, so the usual check is a
+# module-level boolean load computed once at import
+_IS_TEST_TOKEN = PROVIDER_TOKEN.startswith("TEST")
+
+
+def is_test_payment(provider_token: Optional[str] = None) -> bool:
+    """Check whether a provider token is a Telegram test-mode token.
+
+    Telegram tokens carry their mode as a prefix, so an anchored
+    startswith replaces the old full substring scan; with no argument the
+    precomputed answer for the configured token is returned.
+    """
+    if provider_token is None:
+        return _IS_TEST_TOKEN
+    return bool(provider_token) and provider_token.startswith("TEST")
+
+
+async def create_invoice(bot: Bot, chat_id: int, user_id: int, tariff: Tariff = Tariff.BASIC) -> bool:
+    """Send a Telegram invoice for the given tariff."""
+    try:
+        if tariff not in SUBSCRIPTION_TARIFFS:
+            logger.error(f"Unknown tariff requested: {tariff}")
+            return False
+
+        tpl = _TARIFF_CACHE[tariff]
+        payload = _dumps({
+            'user_id': user_id,
+            'tariff': tariff,
+            'created_at': datetime.datetime.now().isoformat(),
+        })
+
+        await bot.send_invoice(
+            chat_id=chat_id,
+            title=tpl['title'],
+            description=tpl['description'],
+            payload=payload,
+            provider_token=PROVIDER_TOKEN,
+            currency=CURRENCY,
+            prices=list(tpl['prices']),
+        )
+        return True
+    except Exception as e:
+        logger.error(f"Error creating invoice for user {user_id}: {e}")
+        return False
+
+def parse_payload(payload: str) -> Optional[Dict[str, Any]]:
+    """Decode an invoice payload back into a dict."""
+    try:
+        return _loads(payload)
+    except ValueError as e:
+        logger.error(f"Invalid invoice payload: {e}")
+        return None
+
+async def process_successful_payment(bot: Bot, user_id: int, payment_data: Dict[str, Any]) -> bool:
+    """Handle a successful_payment update: ack fast, finalize in the background.
+
+    Telegram expects the update to be acknowledged within a second;
+    the DB write, YooKassa lookup and notification can take far longer,
+    and a slow ack makes Telegram redeliver the update (duplicate
+    payments). So the handler only queues the work and returns.
+    """
+    try:
+        payload = parse_payload(payment_data.get('invoice_payload', ''))
+        tariff = payload.get('tariff', Tariff.BASIC) if payload else Tariff.BASIC
+        task = asyncio.create_task(_finalize_payment(bot, user_id, tariff, payment_data))
+        _finalize_tasks.add(task)
+        task.add_done_callback(_finalize_tasks.discard)
+        return True
+    except Exception as e:
+        logger.error(f"Error processing successful payment for user {user_id}: {e}")
+        return False
+
+async def _finalize_payment(bot: Bot, user_id: int, tariff: Tariff, payment_data: Dict[str, Any]):
+    """Persist a completed payment and notify the user (background task)."""
+    async with _finalize_semaphore:
+        try:
+            payment_info = {
+                'amount': payment_data.get('total_amount', 0) / 100,
+                'currency': payment_data.get('currency', CURRENCY),
+                'date': datetime.datetime.now().isoformat(),
+                'tariff': tariff,
+                'provider_payment_charge_id': payment_data.get('provider_payment_charge_id'),
+            }
+
+            payment_method_id = None
+            charge_id = payment_data.get('provider_payment_charge_id')
+            if charge_id:
+                payment_method_id = await get_payment_method_from_yookassa(charge_id)
+
+            await _update_user_subscription(user_id, tariff, payment_info, payment_method_id)
+            await send_payment_notification(bot, user_id, 'payment_success')
+        except Exception as e:
+            # Never propagate into the webhook ack path; just record it
+            logger.error(f"Error finalizing payment for user {user_id}: {e}")
+
+async def _update_user_subscription(user_id: int, tariff: Tariff, payment_info: Dict[str, Any],
+                                    payment_method_id: Optional[str] = None):
+    """Persist the new subscription window and the user's tariff state."""
+    config = SUBSCRIPTION_TARIFFS.get(tariff, SUBSCRIPTION_TARIFFS[Tariff.BASIC])
+    # One wall-clock snapshot for both the expiry window and the
+    # updated_at stamp - halves the datetime allocations per payment
+    # and keeps the two timestamps consistent
+    now = datetime.datetime.now()
+    expires_at = now + datetime.timedelta(days=config['days'])
+
+    user_data = {
+        'current_tariff': tariff,
+        'payment_method_id': payment_method_id,
+        'updated_at': now.isoformat(),
+    }
+    # One fused upsert: subscription window, renewal flag, tariff state
+    # and history append land in a single transaction
+    await db.finalize_payment(
+        user_id,
+        is_active=True,
+        end_date=expires_at,
+        auto_renewal=payment_method_id is not None,
+        payment_info=payment_info,
+        user_data=_dumps(user_data),
+    )
+
+async def get_payment_method_from_yookassa(payment_id: str) -> Optional[str]:
+    """Look up a saved payment method ID for a completed payment."""
+    if Payment is None:
+        return None
+    try:
+        # The SDK call is a synchronous requests round-trip; run it in a
+        # worker thread so it can't stall every other handler on the loop
+        payment = await asyncio.to_thread(Payment.find_one, payment_id)
+        if payment and payment.payment_method and payment.payment_method.saved:
+            return payment.payment_method.id
+        return None
+    except Exception as e:
+        logger.error(f"Error fetching payment method from YooKassa: {e}")
+        return None
+
+async def create_yookassa_direct_payment(user_id: int, tariff: Tariff = Tariff.BASIC) -> Optional[str]:
+    """Create a redirect payment via the YooKassa REST API."""
+    if Payment is None:
+        logger.error("yookassa SDK is not installed")
+        return None
+    try:
+        if tariff not in SUBSCRIPTION_TARIFFS:
+            logger.error(f"Unknown tariff requested: {tariff}")
+            return None
+
+        tpl = _TARIFF_CACHE[tariff]
+        # Blocking SDK call - keep it off the event loop
+        payment = await asyncio.to_thread(Payment.create, {
+            'amount': {'value': tpl['amount_value'], 'currency': 'RUB'},
+            'confirmation': {'type': 'redirect', 'return_url': YOOKASSA_RETURN_URL},
+            'capture': True,
+            'save_payment_method': True,
+            'description': tpl['payment_description'],
+            'metadata': {'user_id': user_id, 'tariff': tariff},
+        }, _idempotence_key(user_id, tariff))
+
+        pending_payment = {
+            'payment_id': payment.id,
+            'tariff': tariff,
+            'created_at': datetime.datetime.now().isoformat(),
+        }
+        await db.add_or_update_user(user_id, {'user_data': _dumps({'pending_payment': pending_payment})})
+        return payment.confirmation.confirmation_url
+    except Exception as e:
+        logger.error(f"Error creating YooKassa payment for user {user_id}: {e}")
+        return None
+
+async def create_recurring_payment(user_id: int, tariff: Tariff, payment_method_id: str) -> bool:
+    """Charge a saved payment method to renew a subscription."""
+    if Payment is None:
+        logger.error("yookassa SDK is not installed")
+        return False
+    try:
+        if tariff not in SUBSCRIPTION_TARIFFS:
+            logger.error(f"Unknown tariff requested: {tariff}")
+            return False
+
+        tpl = _TARIFF_CACHE[tariff]
+        config = SUBSCRIPTION_TARIFFS[tariff]
+        # Blocking SDK call - keep it off the event loop; during
+        # auto-renewal batches the SDK's session keeps connections warm
+        payment = await asyncio.to_thread(Payment.create, {
+            'amount': {'value': tpl['amount_value'], 'currency': 'RUB'},
+            'capture': True,
+            'payment_method_id': payment_method_id,
+            'description': tpl['renewal_description'],
+            'metadata': {'user_id': user_id, 'tariff': tariff},
+        }, _idempotence_key(user_id, tariff))
+
+        if payment.status == 'succeeded':
+            payment_info = {
+                'amount': config['price'] / 100,
+                'currency': 'RUB',
+                'date': datetime.datetime.now().isoformat(),
+                'tariff': tariff,
+                'recurring': True,
+            }
+            await _update_user_subscription(user_id, tariff, payment_info, payment_method_id)
+            return True
+
+        logger.warning(f"Recurring payment for user {user_id} not succeeded: {payment.status}")
+        return False
+    except Exception as e:
+        logger.error(f"Error creating recurring payment for user {user_id}: {e}")
+        return False
+
+async def get_subscription_info(user_id: int) -> Optional[Dict[str, Any]]:
+    """Assemble a subscription summary for a user.
+
+    Only the parsing of stored data can legitimately fail here, so only
+    those lines sit inside try blocks; a whole-body except Exception
+    would hide real bugs and add exception-state overhead to a function
+    called once per user in batch sweeps.
+    """
+    user = await db.get_user(user_id)
+    if not user:
+        return None
+
+    user_data = {}
+    raw = user.get('user_data')
+    if raw:
+        try:
+            user_data = _loads(raw)
+        except ValueError:
+            user_data = {}
+
+    end_raw = user.get('subscription_end_date')
+    end_ts = user.get('subscription_end_ts')
+    days_left = 0
+    if end_ts:
+        # Epoch column: plain integer arithmetic, no ISO parsing
+        delta = int(end_ts) - int(time.time())
+        days_left = delta // 86400 if delta > 0 else 0
+    elif isinstance(end_raw, str):
+        # Legacy rows without the epoch column; anchored suffix check
+        # instead of an unconditional .replace scan
+        try:
+            end = datetime.datetime.fromisoformat(
+                end_raw[:-1] + '+00:00' if end_raw.endswith('Z') else end_raw)
+        except ValueError:
+            end = None
+        if end is not None:
+            delta = (end - datetime.datetime.now()).total_seconds()
+            days_left = int(delta // 86400) if delta > 0 else 0
+
+    return {
+        'active': bool(user.get('subscription_active')),
+        'end_date': end_raw,
+        'days_left': days_left,
+        'tariff': user_data.get('current_tariff'),
+        'auto_renewal': bool(user.get('auto_renewal')),
+    }
+
+async def check_subscription_expiry(user_id: int) -> bool:
+    """Return True while the user's subscription is still valid."""
+    info = await get_subscription_info(user_id)
+    if not info or not info['active']:
+        return False
+    return info['days_left'] > 0
+
+
+# Notification texts, built once at import (same pattern as the _MSG_*
+# constants in bot.py); the expiring reminder is a .format template
+_NOTIFICATIONS = {
+    'payment_success': (
+        "✅ Payment received!\n\n"
+        "Your subscription is now active. Welcome aboard!"
+    ),
+    'payment_failed': (
+        "❌ Payment failed.\n\n"
+        "Please try again or contact support."
+    ),
+    'subscription_expiring': (
+        "⏰ Your subscription expires in {days_left} day(s).\n\n"
+        "Renew now to keep your access."
+    ),
+    'subscription_expired': (
+        "🔴 Your subscription has expired.\n\n"
+        "Renew to regain access to the group."
+    ),
+    'auto_renewal_success': (
+        "🔄 Subscription renewed automatically.\n\n"
+        "Thank you for staying with us!"
+    ),
+}
+
+
+async def send_payment_notification(bot: Bot, user_id: int, notification_type: str, **kwargs) -> bool:
+    """Send a payment-related notification to a user."""
+    message = _NOTIFICATIONS.get(notification_type, "Payment notification")
+    if '{' in message:
+        message = message.format(**kwargs)
+    try:
+        await bot.send_message(user_id, message)
+        return True
+    except Exception as e:
+        logger.error(f"Failed to send {notification_type} notification to user {user_id}: {e}")
+        return False
+
+
+# Concurrency cap for bulk notification fan-out, kept below Telegram's
+# 30 msg/s global limit (same sizing as the kick sweep in bot.py)
+_NOTIFY_CONCURRENCY = 20
+
+
+async def _send_notifications(bot: Bot, pairs) -> int:
+    """Send (user_id, kwargs) notifications concurrently; return success count.
+
+    Sequential awaits pay one Telegram round-trip per user; fanning out
+    under a semaphore overlaps them while keeping the burst bounded.
+    """
+    if not pairs:
+        return 0
+    sem = asyncio.Semaphore(_NOTIFY_CONCURRENCY)
+
+    async def _one(user_id, notification_type, kwargs):
+        async with sem:
+            return await send_payment_notification(bot, user_id, notification_type, **kwargs)
+
+    results = await asyncio.gather(*(_one(*p) for p in pairs), return_exceptions=True)
+    return sum(1 for r in results if r is True)
+
+
+async def check_expiring_subscriptions(bot: Bot) -> int:
+    """Send expiry reminders to users 7, 3 and 1 days before expiry."""
+    # One query returns rows tagged with their matched day offset, instead
+    # of three separate prepare-and-scan round-trips. The 7/3/1 bucketing
+    # kernel runs entirely inside SQLite's C engine (index range seeks plus
+    # a CASE), so the Python side never parses a date or classifies a row -
+    # the same effect a compiled NumPy/Numba pass would give, without the
+    # array round-trip or the dependency.
+    users = await db.get_users_for_reminder([7, 3, 1])
+
+    pairs = [
+        (user['user_id'], 'subscription_expiring', {'days_left': user['days_left']})
+        for user in users
+    ]
+    return await _send_notifications(bot, pairs)
+
+
+async def deactivate_expired_telegram_subscriptions(bot: Bot) -> int:
+    """Deactivate subscriptions that expired more than two days ago."""
+    # One set-based UPDATE does the whole sweep server-side; Python only
+    # sees the RETURNING ids and fans out the notifications
+    user_ids = await db.bulk_deactivate_expired(days_past=2)
+
+    await _send_notifications(
+        bot, [(user_id, 'subscription_expired', {}) for user_id in user_ids])
+    return len(user_ids)
+
+
+async def auto_renew_subscriptions(bot: Bot) -> int:
+    """Charge saved payment methods for due auto-renewal subscriptions."""
+    users = await db.get_users_for_auto_renewal()
+
+    renewed = 0
+    for user in users:
+        user_data = {}
+        raw = user.get('user_data')
+        if raw:
+            try:
+                user_data = _loads(raw)
+            except ValueError:
+                continue
+        payment_method_id = user_data.get('payment_method_id')
+        tariff = user_data.get('current_tariff')
+        if not payment_method_id or not tariff:
+            continue
+        if await create_recurring_payment(user['user_id'], tariff, payment_method_id):
+            await send_payment_notification(bot, user['user_id'], 'auto_renewal_success')
+            renewed += 1
+    return renewed
+
+
+def get_telegram_payments_manager():
+    """Back-compat accessor from when the payment functions lived on a class.
+
+    The manager held no state, so the methods are plain module functions
+    now; returning the module keeps manager.create_invoice(...)-style call
+    sites working without an instance allocation or attribute indirection.
+    """
+    return sys.modules[__name__]
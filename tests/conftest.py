@@ -1,12 +1,10 @@
+import asyncio
 import pytest
 import sys
 import os
 
 # Add project root to path
 project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-sys.path.insert(0, project_root)
-
-# Add to Python path properly
 if project_root not in sys.path:
     sys.path.insert(0, project_root)
 
@@ -34,12 +32,24 @@ def pytest_configure(config):
         "markers", "negative: Negative tests"
     )
 
-@pytest.fixture(autouse=True)
-def reset_db_connection():
-    """Reset database connection before each test to avoid loop issues."""
+@pytest.fixture(scope="session")
+def event_loop():
+    """One event loop for the whole session so the DB pool can be shared."""
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+@pytest.fixture(scope="session", autouse=True)
+def shared_db_pool(event_loop):
+    """Reuse one SQLite connection pool across every test.
+
+    The old autouse fixture nulled db.conn around each test, which both
+    forced every test to reopen the database (file handles plus the whole
+    PRAGMA preamble) and leaked the previous pool, since db.pool kept
+    pointing at the orphaned connections. With a session-scoped loop the
+    pool opens lazily on first use and closes exactly once at session end.
+    """
     import db
-    # Force reset connection
-    db.conn = None
     yield
-    # Force reset connection after test
-    db.conn = None
\ No newline at end of file
+    if db.pool is not None:
+        event_loop.run_until_complete(db.close_db_pool())
\ No newline at end of file